@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+"""
+fake_server.py
+==============
+Local stand-in for civ5-pbem-server implementing the endpoints the client
+uses, with injected latency, bandwidth caps, errors and dropped connections,
+so that the client can be tried and measured offline.
+
+Usage:
+    fake_server.py [options]
+    fake_server.py (-h | --help)
+
+Options:
+    -h --help               Show this
+    --host=<host>           Address to listen on [default: 127.0.0.1]
+    --port=<port>           Port to listen on, 0 for any free one
+                            [default: 8080]
+    --username=<name>       Name of the account created at start
+                            [default: bench]
+    --token=<token>         Access token of that account [default: bench]
+    --games=<n>             Number of games in progress in which that account
+                            is to move [default: 1]
+    --players=<n>           Number of players in each game [default: 4]
+    --size=<bytes>          Approximate size of their saves [default: 5000000]
+    --latency=<seconds>     Delay before each response [default: 0]
+    --jitter=<seconds>      Maximum random delay added to it [default: 0]
+    --bandwidth=<bytes>     Bytes per second each body is sent and received
+                            at, 0 for no limit [default: 0]
+    --error-rate=<p>        Probability of answering 503 [default: 0]
+    --drop-rate=<p>         Probability of closing the connection partway
+                            through a response [default: 0]
+    --seed=<n>              Seed of the injected faults
+    --compress              Compresses saves for clients accepting it
+
+Accounts registered through the server get an access token equal to their
+username, as no email is sent.
+"""
+
+from collections import namedtuple
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from civ5client import delta
+
+import savegen
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Maximum number of players and city states by map size
+map_sizes = {'DUEL':(2, 4), 'TINY':(4, 8), 'SMALL':(6, 12),
+             'STANDARD':(8, 16), 'LARGE':(10, 20), 'HUGE':(12, 24)}
+player_types = ('HUMAN', 'AI', 'CLOSED')
+civilizations = [
+    {'code':'AMERICA', 'name':'America', 'leader':'George Washington'},
+    {'code':'ARABIA', 'name':'Arabia', 'leader':'Harun al-Rashid'},
+    {'code':'CHINA', 'name':'China', 'leader':'Wu Zetian'},
+    {'code':'EGYPT', 'name':'Egypt', 'leader':'Ramesses II'},
+    {'code':'ENGLAND', 'name':'England', 'leader':'Elizabeth'},
+    {'code':'FRANCE', 'name':'France', 'leader':'Napoleon'},
+    {'code':'GERMANY', 'name':'Germany', 'leader':'Bismarck'},
+    {'code':'GREECE', 'name':'Greece', 'leader':'Alexander'},
+    {'code':'INDIA', 'name':'India', 'leader':'Gandhi'},
+    {'code':'JAPAN', 'name':'Japan', 'leader':'Oda Nobunaga'},
+    {'code':'ROME', 'name':'Rome', 'leader':'Augustus Caesar'},
+    {'code':'RUSSIA', 'name':'Russia', 'leader':'Catherine'}]
+# Number of earlier saves kept as delta bases
+kept_bases = 16
+chunk_size = 64*1024
+
+class Faults(namedtuple('Faults', ['latency', 'jitter', 'bandwidth',
+                                   'error_rate', 'drop_rate'])):
+    """
+    Faults injected into every request: a delay of latency plus up to jitter
+    seconds, a cap of bandwidth bytes per second on bodies (0 for none), and
+    the probabilities of answering 503 and of dropping the connection.
+    """
+    __slots__ = ()
+
+    def __new__(cls, latency=0, jitter=0, bandwidth=0, error_rate=0,
+                drop_rate=0):
+        return super().__new__(cls, latency, jitter, bandwidth, error_rate,
+                               drop_rate)
+
+class RequestError(Exception):
+    """Raised by handlers to answer with a status code and a message."""
+
+def etag(data):
+    """Returns a strong ETag of data."""
+    return '"'+sha256(data).hexdigest()[:32]+'"'
+
+def read_multipart(body, content_type):
+    """Returns the parts of a multipart/form-data body by name."""
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not content_type.startswith('multipart/') or boundary is None:
+        raise RequestError(400, "Expected a multipart body")
+    parts = {}
+    delimiter = b'--' + boundary.group(1).encode()
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b'--'):
+            break
+        head, separator, content = part.partition(b'\r\n\r\n')
+        name = re.search(rb'name="([^"]*)"', head)
+        if not separator or name is None:
+            raise RequestError(400, "Malformed multipart body")
+        parts[name.group(1).decode()] = content[:-2] # up to the CRLF
+    return parts
+
+def decode_body(body, encoding):
+    """Decodes a request body sent with a Content-Encoding."""
+    encoding = encoding.lower()
+    if encoding in ('', 'identity'):
+        return body
+    if encoding in ('gzip', 'deflate'):
+        return zlib.decompress(body, 32 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise RequestError(415, "Unsupported content encoding")
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    Server keeping accounts, games and saves in memory. State is changed
+    under lock by the handler threads. With compress, saves are sent
+    compressed to clients accepting it.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, faults=Faults(), seed=None, compress=False):
+        super().__init__(address, Handler)
+        self.faults = faults
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.accounts = {} # by access token
+        self.games = []
+        self.saves = {} # latest save by game id
+        self.bases = {} # saves by checksum, for deltas
+
+    @property
+    def address(self):
+        """Returns the http address the server listens on."""
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        """Serves requests in a background thread and returns the server."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def new_id(self, prefix):
+        return '{}{}'.format(prefix, next(self.ids))
+
+    def add_account(self, username, email, token=None):
+        """Creates an account and returns its access token."""
+        token = token or username
+        self.accounts[token] = {'username':username, 'email':email}
+        return token
+
+    def add_game(self, host, name, description='', map_size='STANDARD'):
+        """
+        Creates a game waiting for players, with the host as its first
+        player and AI players in the other slots. Returns its json.
+        """
+        max_players, city_states = map_sizes[map_size]
+        game_id = self.new_id('game')
+        game = {'id':game_id,
+                'name':name,
+                'host':host,
+                'description':description,
+                'mapSize':map_size,
+                'gameState':'WAITING_FOR_PLAYERS',
+                'lastMoveFinished':None,
+                'turnNumber':0,
+                'currentlyMovingPlayer':None,
+                'isSaveGameValidationEnabled':True,
+                'numberOfCityStates':city_states,
+                'players':[{'id':'{}-player{}'.format(game_id, number),
+                            'humanUserAccount':host if number == 1 else None,
+                            'playerNumber':number,
+                            'civilization':civilizations[
+                                number % len(civilizations)]['code'],
+                            'playerType':'HUMAN' if number == 1 else 'AI'}
+                           for number in range(1, max_players + 1)]}
+        self.games.append(game)
+        return game
+
+    def store_save(self, game, save):
+        """Makes a save the latest one of a game and keeps it as a base."""
+        self.saves[game['id']] = save
+        self.bases[delta.checksum(save)] = save
+        while len(self.bases) > kept_bases:
+            del self.bases[next(iter(self.bases))]
+
+    def populate(self, username, token, games=1, players=4, size=5*10**6,
+                 turn=57):
+        """
+        Adds an account and games in progress in which it's the only human
+        player and is to move, each with a synthetic save.
+        """
+        self.add_account(username, username+'@localhost', token)
+        for number in range(1, games + 1):
+            game = self.add_game(username, 'game{}'.format(number),
+                                 map_size='HUGE')
+            del game['players'][players:]
+            game.update(gameState='IN_PROGRESS', turnNumber=turn,
+                        currentlyMovingPlayer=username,
+                        lastMoveFinished=time.strftime('%Y-%m-%dT%H:%M:%S'))
+            self.store_save(game, savegen.generate_save(
+                size=size, players=1, ai_players=players - 1, turn=turn,
+                current=0, seed=number))
+
+    def finish_turn(self, game, save):
+        """Stores the save of the current player and passes the turn on."""
+        humans = [player['humanUserAccount'] for player in game['players']
+                  if player['playerType'] == 'HUMAN'
+                  and player['humanUserAccount'] is not None]
+        index = humans.index(game['currentlyMovingPlayer'])
+        if game['gameState'] == 'WAITING_FOR_FIRST_MOVE':
+            game['gameState'] = 'IN_PROGRESS'
+        if index + 1 == len(humans):
+            game['turnNumber'] += 1
+        game['currentlyMovingPlayer'] = humans[(index + 1) % len(humans)]
+        game['lastMoveFinished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.store_save(game, save)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    routes = [
+        ('GET', r'/user-accounts/current', 'current_account'),
+        ('POST', r'/user-accounts/register', 'register'),
+        ('POST', r'/user-accounts/reset-access-token', 'reset_access_token'),
+        ('GET', r'/civilizations', 'list_civilizations'),
+        ('GET', r'/games/', 'list_games'),
+        ('POST', r'/games/new-game', 'new_game'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/join', 'join'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/leave', 'leave'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/start', 'start'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/disable-validation',
+         'disable_validation'),
+        ('GET', r'/games/(?P<game_id>[^/]+)/save-game', 'save_game'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/finish-turn', 'finish_turn'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/finish-turn-delta',
+         'finish_turn_delta'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/players/(?P<player_id>[^/]+)/'
+                 r'change-player-type', 'change_player_type'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/players/(?P<player_id>[^/]+)/'
+                 r'choose-civilization', 'choose_civilization'),
+        ('POST', r'/games/(?P<game_id>[^/]+)/players/(?P<player_id>[^/]+)/'
+                 r'kick', 'kick')]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        """
+        Calls the handler of a route with injected faults. Handlers run under
+        the server lock and only set the response, which is sent after.
+        """
+        faults = self.server.faults
+        with self.server.lock:
+            delay = faults.latency + self.server.random.uniform(
+                0, faults.jitter)
+            error = self.server.random.random() < faults.error_rate
+            self.drop = self.server.random.random() < faults.drop_rate
+        path = self.path.split('?')[0]
+        try:
+            body = self.read_body() if method == 'POST' else b''
+            time.sleep(delay)
+            if error:
+                raise RequestError(503, "Injected error")
+            for route_method, pattern, name in self.routes:
+                match = re.fullmatch(pattern, path)
+                if match and route_method == method:
+                    with self.server.lock:
+                        getattr(self, name)(body=body, **match.groupdict())
+                    break
+            else:
+                raise RequestError(404, "No such endpoint")
+        except RequestError as e:
+            self.send_json({'message':e.args[1]}, e.args[0])
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+            return
+        try:
+            self.send_response_body(*self.response)
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+
+    def read_body(self):
+        """Reads the request body at the bandwidth cap and decodes it."""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.read_throttled(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.read_throttled(
+                int(self.headers.get('Content-Length', 0)))
+        return decode_body(body, self.headers.get('Content-Encoding', ''))
+
+    def read_throttled(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.rfile.read(min(chunk_size, size - len(data)))
+            if not chunk:
+                raise ConnectionError("Request body ended early")
+            data += chunk
+            self.throttle(len(chunk))
+        return bytes(data)
+
+    def throttle(self, size):
+        if self.server.faults.bandwidth:
+            time.sleep(size / self.server.faults.bandwidth)
+
+    def send_body(self, body, status=200, headers=()):
+        """Sets the response to send."""
+        self.response = (body, status, headers)
+
+    def send_response_body(self, body, status, headers):
+        """
+        Sends a response at the bandwidth cap, or only part of it before
+        closing the connection if it's to be dropped.
+        """
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        end = len(body)
+        if self.drop:
+            end = self.server.random.randrange(len(body) + 1)
+        for start in range(0, end, chunk_size):
+            chunk = body[start:min(start + chunk_size, end)]
+            self.wfile.write(chunk)
+            self.throttle(len(chunk))
+        if self.drop:
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+
+    def send_json(self, obj, status=200, headers=()):
+        self.send_body(json.dumps(obj).encode(), status,
+                       [('Content-Type', 'application/json')] + list(headers))
+
+    def send_cacheable_json(self, obj):
+        """Sends json with an ETag, or 304 if the client has it already."""
+        body = json.dumps(obj).encode()
+        tag = etag(body)
+        if self.headers.get('If-None-Match') == tag:
+            self.send_body(b'', 304, [('ETag', tag)])
+        else:
+            self.send_body(body, 200, [('Content-Type', 'application/json'),
+                                       ('ETag', tag)])
+
+    def account(self):
+        """Returns the account of the request's access token."""
+        account = self.server.accounts.get(self.headers.get('Access-Token'))
+        if account is None:
+            raise RequestError(401, "Invalid access token")
+        return account
+
+    def json_body(self, body):
+        try:
+            return json.loads(body.decode())
+        except ValueError:
+            raise RequestError(400, "Invalid json")
+
+    def find_game(self, game_id):
+        for game in self.server.games:
+            if game['id'] == game_id:
+                return game
+        raise RequestError(404, "No such game")
+
+    def find_player(self, game, player_id):
+        for player in game['players']:
+            if player['id'] == player_id:
+                return player
+        raise RequestError(404, "No such player")
+
+    def host_game(self, game_id):
+        """Returns a game if the requesting account is its host."""
+        game = self.find_game(game_id)
+        if game['host'] != self.account()['username']:
+            raise RequestError(403, "Only the host can do this")
+        return game
+
+    def own_player(self, game):
+        username = self.account()['username']
+        for player in game['players']:
+            if player['humanUserAccount'] == username:
+                return player
+        return None
+
+    def current_account(self, body):
+        self.send_json(self.account())
+
+    def register(self, body):
+        json_ = self.json_body(body)
+        for account in self.server.accounts.values():
+            if (json_['username'] == account['username']
+                    or json_['email'] == account['email']):
+                raise RequestError(409, "Account already taken")
+        self.server.add_account(json_['username'], json_['email'])
+        self.send_json({'message':"Access token sent"})
+
+    def reset_access_token(self, body):
+        email = self.json_body(body)['email']
+        for token, account in list(self.server.accounts.items()):
+            if account['email'] == email:
+                del self.server.accounts[token]
+                self.server.add_account(account['username'], email)
+                self.send_json({'message':"Access token sent"})
+                return
+        raise RequestError(404, "No account with such an email")
+
+    def list_civilizations(self, body):
+        self.send_cacheable_json(civilizations)
+
+    def list_games(self, body):
+        self.account()
+        self.send_cacheable_json(self.server.games)
+
+    def new_game(self, body):
+        json_ = self.json_body(body)
+        if json_.get('mapSize') not in map_sizes:
+            raise RequestError(400, "Wrong map size")
+        game = self.server.add_game(self.account()['username'],
+                                    json_['gameName'],
+                                    json_.get('gameDescription', ''),
+                                    json_['mapSize'])
+        self.send_json(game)
+
+    def join(self, body, game_id):
+        game = self.find_game(game_id)
+        if self.own_player(game) is not None:
+            raise RequestError(400, "Already in the game")
+        if game['gameState'] != 'WAITING_FOR_PLAYERS':
+            raise RequestError(400, "Game already started")
+        for player in game['players']:
+            if (player['playerType'] == 'HUMAN'
+                    and player['humanUserAccount'] is None):
+                player['humanUserAccount'] = self.account()['username']
+                self.send_json(game)
+                return
+        raise RequestError(400, "No free human player slot")
+
+    def leave(self, body, game_id):
+        game = self.find_game(game_id)
+        player = self.own_player(game)
+        if player is None or game['host'] == player['humanUserAccount']:
+            raise RequestError(400, "Can't leave the game")
+        player['humanUserAccount'] = None
+        self.send_json(game)
+
+    def start(self, body, game_id):
+        game = self.host_game(game_id)
+        if game['gameState'] != 'WAITING_FOR_PLAYERS':
+            raise RequestError(400, "Game already started")
+        if any(player['playerType'] == 'HUMAN'
+               and player['humanUserAccount'] is None
+               for player in game['players']):
+            raise RequestError(400, "Not all human players joined")
+        game.update(gameState='WAITING_FOR_FIRST_MOVE', turnNumber=0,
+                    currentlyMovingPlayer=game['host'])
+        self.send_json(game)
+
+    def disable_validation(self, body, game_id):
+        game = self.host_game(game_id)
+        game['isSaveGameValidationEnabled'] = False
+        self.send_json(game)
+
+    def change_player_type(self, body, game_id, player_id):
+        game = self.host_game(game_id)
+        player = self.find_player(game, player_id)
+        player_type = self.json_body(body).get('playerType')
+        if player_type not in player_types:
+            raise RequestError(400, "Wrong player type")
+        if player['humanUserAccount'] == game['host']:
+            raise RequestError(400, "Can't change the host's type")
+        player['playerType'] = player_type
+        player['humanUserAccount'] = None
+        self.send_json(game)
+
+    def choose_civilization(self, body, game_id, player_id):
+        game = self.find_game(game_id)
+        player = self.find_player(game, player_id)
+        if (player is not self.own_player(game)
+                and game['host'] != self.account()['username']):
+            raise RequestError(403, "Can't choose for another player")
+        code = self.json_body(body).get('civilization')
+        if code not in (civ['code'] for civ in civilizations):
+            raise RequestError(400, "Civilization not allowed")
+        player['civilization'] = code
+        self.send_json(game)
+
+    def kick(self, body, game_id, player_id):
+        game = self.host_game(game_id)
+        player = self.find_player(game, player_id)
+        if player['humanUserAccount'] == game['host']:
+            raise RequestError(400, "Can't kick the host")
+        player['humanUserAccount'] = None
+        self.send_json(game)
+
+    def save_game(self, body, game_id):
+        """
+        Sends the latest save, resuming from a range validated with
+        If-Range, as a delta from X-Delta-Base if the server has that base,
+        or compressed if enabled and the client accepts it.
+        """
+        self.account()
+        game = self.find_game(game_id)
+        save = self.server.saves.get(game_id)
+        if save is None:
+            raise RequestError(404, "No save yet")
+        tag = etag(save)
+        headers = [('ETag', tag)]
+        range_ = re.fullmatch(r'bytes=(\d+)-(\d*)',
+                              self.headers.get('Range', ''))
+        if range_ and self.headers.get('If-Range', tag) == tag:
+            start = int(range_.group(1))
+            end = int(range_.group(2) or len(save) - 1)
+            if start >= len(save) or end < start:
+                self.send_body(b'', 416, [('Content-Range',
+                                           'bytes */{}'.format(len(save)))])
+                return
+            end = min(end, len(save) - 1)
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(save))))
+            self.send_body(save[start:end+1], 206, headers)
+            return
+        base = self.server.bases.get(self.headers.get('X-Delta-Base'))
+        if base is not None:
+            headers.append(('Content-Type', delta.CONTENT_TYPE))
+            self.send_body(delta.encode(base, save), 200, headers)
+            return
+        headers.append(('Content-Type', 'application/octet-stream'))
+        accepted = ''
+        if self.server.compress:
+            accepted = self.headers.get('Accept-Encoding', '')
+        if 'zstd' in accepted and zstandard is not None:
+            save = zstandard.ZstdCompressor().compress(save)
+            headers.append(('Content-Encoding', 'zstd'))
+        elif 'gzip' in accepted:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            save = compressor.compress(save) + compressor.flush()
+            headers.append(('Content-Encoding', 'gzip'))
+        self.send_body(save, 200, headers)
+
+    def moving_game(self, game_id):
+        """Returns a game if the requesting account is to move in it."""
+        game = self.find_game(game_id)
+        if game['gameState'] not in ('WAITING_FOR_FIRST_MOVE', 'IN_PROGRESS'):
+            raise RequestError(400, "Game not started")
+        if game['currentlyMovingPlayer'] != self.account()['username']:
+            raise RequestError(403, "Not your move")
+        return game
+
+    def finish_turn(self, body, game_id):
+        game = self.moving_game(game_id)
+        parts = read_multipart(body, self.headers.get('Content-Type', ''))
+        if 'file' not in parts:
+            raise RequestError(400, "No save file")
+        self.server.finish_turn(game, parts['file'])
+        self.send_json(game)
+
+    def finish_turn_delta(self, body, game_id):
+        game = self.moving_game(game_id)
+        base = self.server.bases.get(self.headers.get('X-Delta-Base'))
+        if base is None:
+            raise RequestError(412, "Unknown delta base")
+        parts = read_multipart(body, self.headers.get('Content-Type', ''))
+        try:
+            save = delta.apply(base, parts['file'])
+        except (KeyError, delta.DeltaMismatchError):
+            raise RequestError(409, "Delta doesn't apply")
+        self.server.finish_turn(game, save)
+        self.send_json(game)
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    faults = Faults(latency=float(opts['--latency']),
+                    jitter=float(opts['--jitter']),
+                    bandwidth=float(opts['--bandwidth']),
+                    error_rate=float(opts['--error-rate']),
+                    drop_rate=float(opts['--drop-rate']))
+    seed = int(opts['--seed']) if opts['--seed'] else None
+    server = FakeServer((opts['--host'], int(opts['--port'])), faults, seed,
+                        compress=opts['--compress'])
+    server.populate(opts['--username'], opts['--token'],
+                    games=int(opts['--games']),
+                    players=int(opts['--players']), size=int(opts['--size']))
+    print("Serving on", server.address, "with access token", opts['--token'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+run.py
+======
+Times the client's hot paths on synthetic saves against fake_server.py and
+prints the results as JSON, so that they can be compared between versions.
+Faults injected by the server let throughput and tail latency be measured
+under poor network conditions.
+
+Usage:
+    run.py [options] [<benchmark>...]
+    run.py (-h | --help)
+
+Options:
+    -h --help               Show this
+    --size=<bytes>          Approximate size of the saves [default: 5000000]
+    --players=<n>           Number of players in a game [default: 4]
+    --games=<n>             Number of games on the server [default: 10]
+    --repeat=<n>            Number of timed runs of each benchmark
+                            [default: 5]
+    --output=<file>         Writes the results to a file instead of printing
+                            them
+    --latency=<seconds>     Delay of the server before each response
+                            [default: 0]
+    --jitter=<seconds>      Maximum random delay added to it [default: 0]
+    --bandwidth=<bytes>     Bytes per second the server sends and receives at,
+                            0 for no limit [default: 0]
+    --error-rate=<p>        Probability of the server answering 503
+                            [default: 0]
+    --drop-rate=<p>         Probability of the server dropping the connection
+                            [default: 0]
+    --seed=<n>              Seed of the injected faults [default: 1]
+    --compress              Makes the server compress downloads for clients
+                            accepting it
+
+Benchmarks (all by default):
+    parse_file              save_parser.parse_file with the default fields
+    parse_file_bitstring    The bitstring parser save_parser replaced, and
+                            whether its output is the same (needs bitstring)
+    inflate_game_data       save_parser.iter_compressed of the whole game
+                            data
+    validate_upload_file    saves.validate_upload_file of an unparsed save
+    validate_upload_file_cached
+                            saves.validate_upload_file of a parsed save
+    download_save           saves.download_save
+    upload_save             saves.upload_save
+    cli_list                cli-client.py list run as a new process
+    cli_version             cli-client.py --version run as a new process,
+                            with its import time and any slow modules it
+                            imported, from python -X importtime
+    import_civ5client       import civ5client in a new process, reported the
+                            same way
+"""
+
+from json import dumps
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+import savegen
+try:
+    import bitstring_parser
+except ImportError: # bitstring is no longer a dependency
+    bitstring_parser = None
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cli_client = os.path.join(repo_dir, 'cli-client.py')
+# Modules slow to import, which civ5client imports where they're used
+slow_modules = ('asyncio', 'requests', 'requests_toolbelt', 'tqdm')
+
+config_template = """[Client Settings]
+log_name = log.txt
+log_responses = False
+games_cache_ttl = 0
+credentials_cache_ttl = 0
+
+[Interface Settings]
+server_address = {address}
+access_token = bench
+
+[Saves]
+save_path = {save_path}
+delete_saves = False
+metadata_index = False
+"""
+
+def percentile(times, fraction):
+    """Returns the nearest-rank percentile of a list of times."""
+    ordered = sorted(times)
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+def time_runs(function, repeat, setup=None):
+    """
+    Calls function repeat times, each after setup if given, and returns
+    statistics of the times in seconds of the calls that didn't raise an
+    exception, and the number of those that did.
+    """
+    times = []
+    errors = 0
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        try:
+            function()
+        except Exception:
+            errors += 1
+        else:
+            times.append(time.perf_counter() - start)
+    if not times:
+        return {'repeat':repeat, 'errors':errors}
+    return {'repeat':repeat,
+            'errors':errors,
+            'min':min(times),
+            'median':statistics.median(times),
+            'mean':statistics.mean(times),
+            'p95':percentile(times, 0.95),
+            'max':max(times),
+            'times':times}
+
+def git_commit():
+    """Returns the commit of the benchmarked tree, or None if unknown."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def import_times(args, cwd=None):
+    """
+    Runs python -X importtime with args and returns a list of the modules
+    imported, as tuples of the name, how deeply nested the import was and
+    its cumulative time in microseconds.
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            cwd=cwd, env=dict(os.environ, PYTHONPATH=repo_dir),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            check=True).stderr.decode()
+    times = []
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s*\d+ \|\s*(\d+) \| ( *)(\S+)', line)
+        if match:
+            times.append((match.group(3), len(match.group(2)) // 2,
+                          int(match.group(1))))
+    return times
+
+def slow_imports(times):
+    """Returns the modules of slow_modules and their submodules in times."""
+    return sorted(name for name, depth, time_ in times
+                  if name.split('.')[0] in slow_modules)
+
+def import_report(args):
+    """
+    Returns the total import time in microseconds of python run with args
+    and the slow modules it imported.
+    """
+    times = import_times(args, cwd=os.getcwd())
+    return {'import_us':sum(time_ for name, depth, time_ in times
+                            if depth == 0),
+            'slow_imports':slow_imports(times)}
+
+def write_config(work_dir, address, save_path):
+    """Writes a config.ini for the local server into work_dir."""
+    with open(os.path.join(work_dir, 'config.ini'), 'w') as config_file:
+        config_file.write(config_template.format(address=address,
+                                                 save_path=save_path))
+
+def run_benchmarks(names, save_name, repeat):
+    """
+    Runs the named benchmarks in a directory with a config.ini for the
+    local server. Returns the results by benchmark name.
+    """
+    sys.path.insert(0, repo_dir)
+    import civ5client
+    from civ5client import games, save_parser, saves
+
+    interface = civ5client.Interface.from_config()
+    game = games.Game(interface, games.list_games(interface)[0][0])
+    size = os.path.getsize(save_name)
+
+    def clear_metadata():
+        saves.metadata_caches.clear()
+
+    def parse_file_bitstring():
+        if bitstring_parser is None:
+            return {'skipped':"bitstring is not installed"}
+        return dict(time_runs(lambda: bitstring_parser.parse_file(save_name),
+                              repeat),
+                    same_output=(bitstring_parser.parse_file(save_name)
+                                 == save_parser.parse_file(save_name)))
+
+    benchmarks = {
+        'parse_file':lambda: time_runs(
+            lambda: save_parser.parse_file(save_name), repeat),
+        'parse_file_bitstring':parse_file_bitstring,
+        'inflate_game_data':lambda: time_runs(
+            lambda: sum(map(len, save_parser.iter_compressed(save_name))),
+            repeat),
+        'validate_upload_file':lambda: time_runs(
+            lambda: saves.validate_upload_file(game, save_name), repeat,
+            setup=clear_metadata),
+        'validate_upload_file_cached':lambda: time_runs(
+            lambda: saves.validate_upload_file(game, save_name), repeat,
+            setup=lambda: saves.validate_upload_file(game, save_name)),
+        'download_save':lambda: dict(time_runs(
+            lambda: saves.download_save(game), repeat), bytes=size),
+        'upload_save':lambda: dict(time_runs(
+            lambda: saves.upload_save(game, save_name), repeat), bytes=size),
+        'cli_list':lambda: time_runs(
+            lambda: subprocess.run([sys.executable, cli_client, 'list'],
+                                   stdout=subprocess.DEVNULL, check=True),
+            repeat),
+        'cli_version':lambda: dict(time_runs(
+            lambda: subprocess.run([sys.executable, cli_client, '--version'],
+                                   stdout=subprocess.DEVNULL, check=True),
+            repeat), **import_report([cli_client, '--version'])),
+        'import_civ5client':lambda: dict(time_runs(
+            lambda: subprocess.run([sys.executable, '-c', 'import civ5client'],
+                                   env=dict(os.environ, PYTHONPATH=repo_dir),
+                                   check=True),
+            repeat), **import_report(['-c', 'import civ5client']))}
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        raise SystemExit("Unknown benchmark: "+", ".join(unknown))
+    results = {}
+    with interface:
+        for name in names or benchmarks:
+            results[name] = benchmarks[name]()
+    return results
+
+def main(opts):
+    size = int(opts['--size'])
+    players = int(opts['--players'])
+    games = int(opts['--games'])
+    repeat = int(opts['--repeat'])
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        save_path = os.path.join(work_dir, 'saves') + os.sep
+        os.mkdir(save_path)
+        # civ5client reads config.ini from the working directory once, when
+        # fake_server first imports it, so the config is written before and
+        # the address of the server filled in once it's bound
+        write_config(work_dir, '', save_path)
+        os.chdir(work_dir)
+        try:
+            import fake_server
+            from civ5client import config
+            faults = fake_server.Faults(latency=float(opts['--latency']),
+                                        jitter=float(opts['--jitter']),
+                                        bandwidth=float(opts['--bandwidth']),
+                                        error_rate=float(opts['--error-rate']),
+                                        drop_rate=float(opts['--drop-rate']))
+            server = fake_server.FakeServer(('127.0.0.1', 0), faults,
+                                            int(opts['--seed']),
+                                            compress=opts['--compress'])
+            # The account is the only human player in its games, so it's to
+            # move again after each upload
+            server.populate('bench', 'bench', games=games, players=players,
+                            size=size)
+            turn = server.games[0]['turnNumber']
+            # A save of the turn done, to validate and upload
+            save_name = os.path.join(work_dir, 'turn.Civ5Save')
+            savegen.write_save(save_name, size=size, players=1,
+                               ai_players=players - 1, turn=turn + 1,
+                               current=0)
+            config.set_options('Interface Settings',
+                               {'server_address':server.address})
+            server.start()
+            try:
+                results = run_benchmarks(opts['<benchmark>'], save_name,
+                                         repeat)
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            os.chdir(cwd)
+    return {'commit':git_commit(),
+            'python':platform.python_version(),
+            'platform':platform.platform(),
+            'time':time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'parameters':dict(faults._asdict(), size=size, players=players,
+                              games=games, repeat=repeat,
+                              compress=opts['--compress']),
+            'benchmarks':results}
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    output = dumps(main(opts), indent=2)
+    if opts['--output']:
+        with open(opts['--output'], 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+savegen.py
+==========
+Writes synthetic .Civ5Save files laid out like the ones save_parser reads,
+for benchmarks.
+
+Usage:
+    savegen.py <file> [--size=<bytes>] [--players=<n>] [--ai-players=<n>]
+               [--turn=<n>] [--current=<n>] [--seed=<n>]
+    savegen.py (-h | --help)
+
+Options:
+    -h --help           Show this
+    --size=<bytes>      Approximate size of the save [default: 5000000]
+    --players=<n>       Number of human players [default: 4]
+    --ai-players=<n>    Number of AI players after them [default: 0]
+    --turn=<n>          Turn number [default: 57]
+    --current=<n>       Number of the current player, counted from 0
+                        [default: 1]
+    --seed=<n>          Seed of the random contents [default: 1]
+"""
+
+import random
+import struct
+import zlib
+
+from docopt import docopt
+
+BLOCK_MARKER = b'\x40\x00\x00\x00'
+BLOCK_COUNT = 14
+BLOCK_SIZE = 64
+MAX_PLAYERS = 22
+
+def pack_string(string):
+    """Returns a string as the save stores it, prefixed with its length."""
+    data = string.encode()
+    return struct.pack('<i', len(data)) + data
+
+def random_bytes(rnd, size, marker_free=False):
+    """
+    Returns size random bytes. marker_free ones contain no zero bytes, so
+    that they can't be mistaken for a block marker.
+    """
+    if marker_free:
+        return bytes(rnd.randrange(1, 256) for i in range(size))
+    return rnd.getrandbits(8 * size).to_bytes(size, 'little')
+
+def game_data(rnd, size):
+    """
+    Returns zlib compressed game data of about size bytes. Its layout isn't
+    known, so it's random, which doesn't compress and so keeps the size.
+    """
+    return zlib.compress(random_bytes(rnd, max(0, size)))
+
+def generate_save(size=5*10**6, players=4, ai_players=0, turn=57, current=1,
+                  passwords=(0,), seed=1):
+    """
+    Returns the contents of a save of about size bytes with players human
+    players followed by ai_players AI players. Players numbered in passwords
+    have set a password.
+    """
+    rnd = random.Random(seed)
+    data = bytearray(b'CIV5' + struct.pack('<i', 8) + pack_string('1.0.3.279')
+                     + pack_string('403694 (Steam)') + struct.pack('<i', turn))
+    for block in range(BLOCK_COUNT):
+        if block == 8:
+            data += struct.pack('<4i', current, 0, 0, 0)
+        data += BLOCK_MARKER
+        if block == 2:
+            statuses = ([3] * players + [1] * ai_players
+                        + [4] * (MAX_PLAYERS - players - ai_players))
+            data += struct.pack('<{}i'.format(MAX_PLAYERS), *statuses)
+        elif block == 11:
+            for i in range(MAX_PLAYERS):
+                data += pack_string('password' if i in passwords else '')
+        else:
+            data += random_bytes(rnd, BLOCK_SIZE, marker_free=True)
+    data += game_data(rnd, size - len(data))
+    return bytes(data)
+
+def write_save(file_name, **kwargs):
+    """Writes a save made by generate_save and returns its size."""
+    data = generate_save(**kwargs)
+    with open(file_name, 'wb') as file_:
+        file_.write(data)
+    return len(data)
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    write_save(opts['<file>'], size=int(opts['--size']),
+               players=int(opts['--players']),
+               ai_players=int(opts['--ai-players']), turn=int(opts['--turn']),
+               current=int(opts['--current']), seed=int(opts['--seed']))
@@ -3,34 +3,75 @@ civ5client
 ==========
 Package to interact with civ5-pbem-server by http requests.
 """
+# requests, tqdm, requests_toolbelt and asyncio take long to import, so they
+# are imported where they're used, keeping the start of commands that don't
+# need them fast
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import json
+import logging
+import logging.handlers
+import os.path
 import time
 import sys
+import traceback
 
 if sys.version_info.major == 3 and sys.version_info.minor < 5:
     from simplejson.decoder import JSONDecodeError
 else:
     from json.decoder import JSONDecodeError
-from configparser import ConfigParser
 from urllib.parse import urlparse, urlunparse, urljoin
-from tqdm import tqdm
-from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
-import requests
 
-# config initialization
-# TODO: Is this really the best way?
-config_file_name = "config.ini"
+from civ5client import compression, config, profiling
+from civ5client.cache import FileCache
 
-config = ConfigParser()
-config.read(config_file_name)
-if not config.has_section('Client Settings'):
-    config.add_section('Client Settings')
+config_file_name = config.file_name
 
 if (not config.has_option('Client Settings', 'log_name')
         or not config.has_option('Client Settings', 'log_responses')):
-    config['Client Settings']['log_name'] = "log.txt"
-    config['Client Settings']['log_responses'] = "False"
-log_file_name = config['Client Settings']['log_name']
-log_responses = (config['Client Settings']['log_responses'].lower() == "true")
+    log_file_name = "log.txt"
+    log_responses = False
+else:
+    log_file_name = config.get('Client Settings', 'log_name')
+    log_responses = config.getboolean('Client Settings', 'log_responses')
+# response log settings, optional in config: bodies are cut after
+# log_body_limit bytes, records are written log_buffer_size at a time and the
+# log is rotated at log_max_bytes, keeping log_backup_count old logs
+log_body_limit = config.getint('Client Settings', 'log_body_limit',
+                               fallback=1024)
+log_buffer_size = config.getint('Client Settings', 'log_buffer_size',
+                                fallback=64)
+log_max_bytes = config.getint('Client Settings', 'log_max_bytes',
+                              fallback=1024*1024)
+log_backup_count = config.getint('Client Settings', 'log_backup_count',
+                                 fallback=3)
+log_json = config.getboolean('Client Settings', 'log_json', fallback=False)
+response_loggers = {} # by log file name
+
+# connection pool & timeout settings, optional in config
+pool_size = config.getint('Client Settings', 'pool_size', fallback=10)
+connect_timeout = config.getfloat('Client Settings', 'connect_timeout',
+                                  fallback=10.0)
+read_timeout = config.getfloat('Client Settings', 'read_timeout',
+                               fallback=60.0)
+
+# compressed save transfer: none, gzip or zstd
+compression_method = config.get('Client Settings', 'compression',
+                                fallback='none')
+compression_level = config.getint('Client Settings', 'compression_level',
+                                  fallback=6)
+
+# on-disk caches are kept next to the config file
+def cache_file_name(name):
+    """Returns the path of a cache file placed next to the config file."""
+    return os.path.join(os.path.dirname(config_file_name), name)
+
+credentials_cache_ttl = config.getfloat('Client Settings',
+                                       'credentials_cache_ttl', fallback=0)
+credentials_cache = FileCache(cache_file_name("credentials_cache.json"),
+                              ttl=credentials_cache_ttl,
+                              enabled=credentials_cache_ttl > 0)
 
 class InvalidConfigurationError(Exception):
     """Raised when configuration is insufficient."""
@@ -46,109 +87,376 @@ def parse_address(address):
         ('https',netloc,"","","","")) # TODO: handle non-https addresses
     return out_address
 
+def response_logger(log_file):
+    """
+    Returns the logger writing to a response log file. Its records are
+    buffered in memory and written log_buffer_size at a time, when an error
+    is logged or at exit, to a log rotated at log_max_bytes.
+    """
+    if log_file not in response_loggers:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=log_max_bytes, backupCount=log_backup_count,
+            encoding='utf-8', delay=True)
+        file_handler.setFormatter(logging.Formatter('%(message)s'))
+        handler = logging.handlers.MemoryHandler(
+            log_buffer_size, flushLevel=logging.ERROR, target=file_handler)
+        logger = logging.getLogger('civ5client.responses.'+log_file)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        response_loggers[log_file] = logger
+    return response_loggers[log_file]
+
+def loggable_headers(headers):
+    """Returns headers as a dict, without the access token."""
+    headers = dict(headers)
+    if 'Access-Token' in headers:
+        headers['Access-Token'] = '<hidden>'
+    return headers
+
 def log_response(response, log_file=log_file_name, stream=False):
-    """Writes down the request sent and response received in a log file."""
-    with open(log_file, 'a') as log:
-        time_str = "Request at " + time.strftime("%Y-%m-%d %H:%M:%S")
-        log.write(time_str)
-        log.write('\n')
-        request = response.request
-        log.write("sent to " + str(request.url))
-        log.write('\n')
-        if not stream:
-            log.write("received response: " + str(response.content))
-        else:
-            log.write("received a long stream response")
-        log.write('\n\n')
+    """
+    Writes down the request sent and response received in a log file: the
+    headers, status and time to the response, and the start of the body
+    unless it's streamed. The log is written as text or, with log_json, as
+    json lines.
+    """
+    request = response.request
+    record = {'time':time.strftime("%Y-%m-%d %H:%M:%S"),
+              'method':request.method,
+              'url':request.url,
+              'status':response.status_code,
+              'elapsed':response.elapsed.total_seconds(),
+              'request_headers':loggable_headers(request.headers),
+              'response_headers':dict(response.headers)}
+    if not stream:
+        body = response.content
+        record['body_length'] = len(body)
+        record['body'] = body[:log_body_limit]
+    level = logging.INFO if response.status_code < 400 else logging.ERROR
+    logger = response_logger(log_file)
+    if log_json:
+        if 'body' in record:
+            record['body'] = record['body'].decode('utf-8', 'replace')
+        logger.log(level, json.dumps(record))
+        return
+    lines = ["Request at " + record['time'],
+             "sent {} to {}".format(record['method'], record['url']),
+             "status {} after {:.3f} s".format(record['status'],
+                                               record['elapsed']),
+             "request headers: " + str(record['request_headers']),
+             "response headers: " + str(record['response_headers'])]
+    if stream:
+        lines.append("received a long stream response")
+    else:
+        lines.append("received response: " + str(record['body']))
+        if record['body_length'] > log_body_limit:
+            lines.append("({} of {} bytes shown)".format(
+                log_body_limit, record['body_length']))
+    logger.log(level, "\n".join(lines) + "\n")
+
+def log_error(error, log_file=log_file_name):
+    """
+    Writes the traceback of an error to the response log. Records buffered
+    before it are written first, so the log stays in order.
+    """
+    text = "".join(traceback.format_exception(type(error), error,
+                                              error.__traceback__))
+    logger = response_logger(log_file)
+    if log_json:
+        logger.error(json.dumps({'time':time.strftime("%Y-%m-%d %H:%M:%S"),
+                                 'traceback':text}))
+        return
+    logger.error(text)
+
+class NoProgressBar():
+    """Stands in for a tqdm bar when no progress is to be shown."""
+    n = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        pass
+
+    def update(self, n):
+        pass
+
+def new_session(pool_size=pool_size):
+    """
+    Creates a keep-alive requests session with a connection pool of a given
+    size, so that consecutive requests to a server reuse the same connection.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def check_response(response, statuses=(200,)):
+    """Raises a ServerError if the response status code is not expected."""
+    if response.status_code not in statuses:
+        message = response.status_code
+        try:
+            json = response.json()
+            if 'message' in json:
+                message = json['message']
+        except JSONDecodeError:
+            message = 'No json to retrieve message from'
+        raise ServerError(message, response.content)
 
 class Interface():
     """
     Class describing a correct server url together with an access token
     to communicate with it. All client-server interactions aside from
     registration require it.
+    Requests are sent through a pooled keep-alive session, which should be
+    closed with close() or by using the Interface as a context manager.
     """
 
-    def __init__(self, server_address, access_token):
+    def __init__(self, server_address, access_token, session=None,
+                 timeout=(connect_timeout, read_timeout)):
         self.server_address = server_address # must be complete url with http:
         self.access_token = access_token
+        self.session = session if session is not None else new_session()
+        self.timeout = timeout # (connect, read) in seconds
+        self.credentials = None
+        self.download_encoding = compression.supported_encoding(
+            compression_method)
+        self.upload_encoding = self.download_encoding
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the session and all pooled connections."""
+        self.session.close()
 
     @classmethod
-    def from_config(cls):
+    def from_config(cls, session=None):
         """Creates an Interface based on a config file."""
-        config = ConfigParser()
-        config.read(config_file_name)
-        if (config.has_section('Interface Settings')
-                and config.has_option('Interface Settings', 'server_address')
+        if (config.has_option('Interface Settings', 'server_address')
                 and config.has_option('Interface Settings', 'access_token')):
-            server_address = config['Interface Settings']['server_address']
-            access_token = config['Interface Settings']['access_token']
-            return cls(server_address, access_token) 
+            server_address = config.get('Interface Settings', 'server_address')
+            access_token = config.get('Interface Settings', 'access_token')
+            return cls(server_address, access_token, session=session)
         else:
             raise InvalidConfigurationError
 
     def save_config(self):
         """Saves the Interface information in a config file."""
-        config = ConfigParser()
-        config.read(config_file_name)
-        if not config.has_section('Interface Settings'):
-            config.add_section('Interface Settings')
-        config['Interface Settings']['server_address'] = self.server_address
-        config['Interface Settings']['access_token'] = self.access_token
-        with open(config_file_name, 'w') as config_file:
-            config.write(config_file)
-
-    def get_request(self, path, stream=False, log=log_responses):
-        ###TODO: headers? data? anything? No real activities to perform for now
-        response = requests.get(
+        config.set_options('Interface Settings',
+                           {'server_address':self.server_address,
+                            'access_token':self.access_token})
+        self.credentials = None
+        credentials_cache.clear()
+
+    def cache_key(self):
+        """
+        Returns a key identifying the server and access token, without
+        revealing the token itself.
+        """
+        return hashlib.sha256(
+            (self.server_address+" "+self.access_token).encode()).hexdigest()
+
+    def get_credentials(self):
+        """
+        Returns the json describing the account tied to the access token.
+        It's requested from the server once per Interface and, if enabled,
+        kept on disk for credentials_cache_ttl seconds.
+        """
+        if self.credentials is None:
+            with profiling.span("get_credentials"):
+                self.credentials = credentials_cache.get(self.cache_key())
+                if self.credentials is None:
+                    self.credentials = self.get_request(
+                        "/user-accounts/current").json()
+                    credentials_cache.put(self.cache_key(), self.credentials)
+        return self.credentials
+
+    def get_request(self, path, stream=False, log=log_responses,
+                    timeout=None, headers=None, statuses=(200,)):
+        """
+        Sends a get request with additional headers if given. Raises
+        ServerError unless the response status code is one of statuses.
+        """
+        all_headers = {"Access-Token":self.access_token}
+        if headers is not None:
+            all_headers.update(headers)
+        start = time.perf_counter()
+        response = self.session.get(
             urljoin(self.server_address, path), 
-            headers={"Access-Token":self.access_token},
-            stream=stream)
+            headers=all_headers,
+            stream=stream,
+            timeout=timeout or self.timeout)
+        profiling.record_request('GET', path, response, start, stream=stream)
         if log:
             if response.status_code != 200:
                 stream = False
             log_response(response, stream=stream)
-        if response.status_code != 200:
-            message = response.status_code
-            try:
-                json = response.json()
-                if 'message' in json:
-                    message = json['message']
-            except JSONDecodeError:
-                message = 'No json to retrieve message from'
-            raise ServerError(message, response.content)
+        check_response(response, statuses)
         return response
     
-    def post_request(self, path, json=None, files=None, log=log_responses, bar=False):
-        if files is not None and bar:
-            _files_dict = {
-                    key: (key, file_, 'text/plain') for key, file_ in files.items()}
-            encoder = MultipartEncoder(_files_dict)
-            with tqdm(total=encoder.len, 
-                      unit_scale=True, desc='Uploading') as tqdm_bar:
-                monitor = MultipartEncoderMonitor(encoder, 
-                        lambda monitor: tqdm_bar.update(
-                            monitor.bytes_read - tqdm_bar.n))
-                response = requests.post(
-                    urljoin(self.server_address, path),
-                    json=json,
-                    data=monitor,
-                    headers={"Access-Token": self.access_token,
-                             "Content-Type": monitor.content_type})
+    def post_request(self, path, json=None, files=None, log=log_responses,
+                     bar=False, timeout=None, compress=False, headers=None,
+                     statuses=(200,)):
+        """
+        Sends a post request with json or multipart files and additional
+        headers if given. With compress the files are compressed on the fly
+        with the configured encoding, see post_compressed. Raises ServerError
+        unless the response status code is one of statuses.
+        """
+        all_headers = {"Access-Token":self.access_token}
+        if headers is not None:
+            all_headers.update(headers)
+        if files is not None and compress and self.upload_encoding:
+            response = self.post_compressed(path, files, bar=bar,
+                                            timeout=timeout,
+                                            headers=all_headers, log=log)
+        elif files is not None and bar:
+            start = time.perf_counter()
+            response = self.post_multipart(path, files, bar=bar,
+                                           timeout=timeout,
+                                           headers=all_headers)
+            profiling.record_request('POST', path, response, start)
         else:
-            response = requests.post(
+            start = time.perf_counter()
+            response = self.session.post(
                 urljoin(self.server_address, path),
                 json=json,
                 files=files,
-                headers={"Access-Token":self.access_token})
+                headers=all_headers,
+                timeout=timeout or self.timeout)
+            profiling.record_request('POST', path, response, start)
+        if log:
+            log_response(response)
+        check_response(response, statuses)
+        return response
+
+    def post_compressed(self, path, files, bar=False, timeout=None,
+                        headers=None, log=log_responses):
+        """
+        Posts files as a multipart body compressed with the upload encoding.
+        A server answering 411 or 415 can't take such a body and stored
+        nothing, so the files are sent again uncompressed and uploads stop
+        being compressed. Other responses, such as a 400 rejecting the save
+        or a server error that may come after the turn was stored, are
+        returned as they are, as the post can't safely be repeated.
+        """
+        start = time.perf_counter()
+        response = self.post_multipart(path, files, bar=bar, timeout=timeout,
+                                       encoding=self.upload_encoding,
+                                       headers=headers)
+        profiling.record_request('POST', path, response, start)
+        if response.status_code not in (411, 415):
+            return response
         if log:
             log_response(response)
-        if response.status_code != 200:
-            message = response.status_code
-            try:
-                json = response.json()
-                if 'message' in json:
-                    message = json['message']
-            except JSONDecodeError:
-                message = 'No json to retrieve message from'
-            raise ServerError(message, response.content)
+        for file_ in files.values():
+            file_.seek(0)
+        self.upload_encoding = None
+        start = time.perf_counter()
+        response = self.post_multipart(path, files, bar=bar, timeout=timeout,
+                                       headers=headers)
+        profiling.record_request('POST', path, response, start)
         return response
+
+    def post_multipart(self, path, files, bar=False, timeout=None,
+                       encoding=None, headers=None):
+        """
+        Posts files as a streamed multipart body, with a progress bar if bar
+        is set and compressed if an encoding is given.
+        """
+        from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+        _files_dict = {
+                key: (key, file_, 'text/plain') for key, file_ in files.items()}
+        encoder = MultipartEncoder(_files_dict)
+        if bar:
+            from tqdm import tqdm
+            progress = tqdm(total=encoder.len, unit_scale=True,
+                            desc='Uploading')
+        else:
+            progress = NoProgressBar()
+        with progress:
+            monitor = MultipartEncoderMonitor(encoder, 
+                    lambda monitor: progress.update(
+                        monitor.bytes_read - progress.n))
+            headers = dict(headers or {"Access-Token": self.access_token})
+            headers["Content-Type"] = monitor.content_type
+            data = monitor
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+                data = compression.compress_stream(monitor, encoding,
+                                                   compression_level)
+            return self.session.post(
+                urljoin(self.server_address, path),
+                data=data,
+                headers=headers,
+                timeout=timeout or self.timeout)
+
+class AsyncInterface():
+    """
+    Wraps an Interface to expose its requests as coroutines. The requests are
+    run by a pool of threads sharing the Interface's session, so independent
+    requests can be awaited concurrently and take about one round trip in
+    total.
+    """
+
+    def __init__(self, interface, max_workers=pool_size):
+        self.interface = interface
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def close(self):
+        """Waits for running requests and stops the worker threads."""
+        self.executor.shutdown()
+
+    @staticmethod
+    def run(coroutine):
+        """Runs a coroutine in a new event loop and returns its result."""
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def run_in_executor(self, function, *args, **kwargs):
+        """Returns a future of a blocking call performed by a worker thread."""
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    async def get_credentials(self):
+        """Coroutine version of Interface.get_credentials."""
+        return await self.run_in_executor(self.interface.get_credentials)
+
+    async def get_request(self, path, **kwargs):
+        """Coroutine version of Interface.get_request."""
+        return await self.run_in_executor(
+            self.interface.get_request, path, **kwargs)
+
+    async def stream_request(self, path, **kwargs):
+        """
+        Coroutine sending a streamed get request. The body of the returned
+        response is not read yet.
+        """
+        return await self.run_in_executor(
+            self.interface.get_request, path, stream=True, **kwargs)
+
+    async def post_request(self, path, **kwargs):
+        """Coroutine version of Interface.post_request."""
+        return await self.run_in_executor(
+            self.interface.post_request, path, **kwargs)
@@ -3,18 +3,25 @@ This module contians account related actions, such as registration.
 """
 
 from urllib.parse import urlparse, urlunparse, urljoin
-import requests
 
-from civ5client import ServerError, log_responses, log_response
+from civ5client import (ServerError, log_responses, log_response,
+                        connect_timeout, read_timeout, credentials_cache)
 
 class AccountTakenError(Exception):
     """Raised when attempting to register a taken account."""
 
-def register_account(server_address, username, email, log=log_responses):
-    """Sends a registration request with a given email and username."""
-    register_request = requests.post(
+def register_account(server_address, username, email, log=log_responses,
+                     session=None):
+    """
+    Sends a registration request with a given email and username. A session,
+    e.g. one of an Interface, can be given to reuse its connections.
+    """
+    if session is None:
+        import requests as session
+    register_request = session.post(
         urljoin(server_address,"/user-accounts/register"),
-        json={'email':email, 'username':username})
+        json={'email':email, 'username':username},
+        timeout=(connect_timeout, read_timeout))
     if log:
         log_response(register_request)
     # TODO: A non-200 status code could mean a lot of things
@@ -23,18 +30,24 @@ def register_account(server_address, username, email, log=log_responses):
 
 def request_credentials(interface):
     """Requests credentials given by a specific Interface, i.e.
-    related to a specific access token on a server.
+    related to a specific access token on a server. Use
+    Interface.get_credentials to avoid repeating the request.
     """
     request = interface.get_request("/user-accounts/current")
     return request
 
-def reset_access_token(server_address, email, log=log_responses):
+def reset_access_token(server_address, email, log=log_responses,
+                       session=None):
     """Sends a request to reset the access token and send a new
-    one via mail.
+    one via mail. A session can be given to reuse its connections.
     """
-    reset_request = requests.post(
+    if session is None:
+        import requests as session
+    reset_request = session.post(
         urljoin(server_address,"/user-accounts/reset-access-token"),
-        json={'email':email})
+        json={'email':email},
+        timeout=(connect_timeout, read_timeout))
     if log:
         log_response(reset_request)
+    credentials_cache.clear()
     return reset_request
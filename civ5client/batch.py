@@ -0,0 +1,67 @@
+"""
+This module contains running an action on many games at once.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from civ5client import config, games, NoProgressBar
+
+# Number of games handled at once by batch commands
+batch_workers = config.getint('Client Settings', 'batch_workers', fallback=4)
+
+class BatchResult(namedtuple('BatchResult', ['game', 'value', 'error'])):
+    """
+    Outcome of an action on a game: its return value, or the exception it
+    raised as error.
+    """
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def is_pattern(reference):
+    """Returns whether a game reference is a glob pattern over names."""
+    return any(char in reference for char in '*?[')
+
+def select_games(interface, index, reference=None):
+    """
+    Returns the Games of a GameIndex a reference points to: all of them if
+    it's None, those whose name matches it if it's a glob pattern, or the
+    game it refers to otherwise.
+    """
+    if reference is None:
+        game_list = index.game_list
+    elif is_pattern(reference):
+        game_list = index.matching(reference)
+    else:
+        return [games.Game.from_any(interface, reference, index)]
+    return [games.Game(interface, game_json) for game_json in game_list]
+
+def run_batch(action, game_list, workers=batch_workers, bar=False):
+    """
+    Calls action with each Game of a list in a pool of at most workers
+    threads. The Games should share one Interface, so that its identity is
+    looked up once. With bar, the progress over all games is shown.
+    Returns BatchResults in the order of the games.
+    """
+    # The identity is looked up before the threads would race for it
+    if game_list:
+        game_list[0].interface.get_credentials()
+    if bar:
+        from tqdm import tqdm
+        progress = tqdm(desc="Games", unit='game', total=len(game_list))
+    else:
+        progress = NoProgressBar()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor, \
+            progress:
+        futures = {executor.submit(action, game):game for game in game_list}
+        for future in as_completed(futures):
+            game = futures[future]
+            try:
+                results[game.id] = BatchResult(game, future.result(), None)
+            except Exception as e:
+                results[game.id] = BatchResult(game, None, e)
+            progress.update(1)
+    return [results[game.id] for game in game_list]
@@ -0,0 +1,120 @@
+"""
+This module contains a small persistent cache used to avoid repeating
+requests whose responses rarely change.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+class FileCache():
+    """
+    Keeps json-serializable values under string keys in a single json file,
+    each together with the time it was stored and optional metadata. Values
+    older than ttl seconds are not fresh, but stay available for
+    revalidation.
+    """
+
+    def __init__(self, file_name, ttl=0, enabled=True):
+        self.file_name = file_name
+        self.ttl = ttl
+        self.enabled = enabled
+        self._data = {}
+        self._stat = None
+
+    def load(self):
+        """
+        Returns the whole content of the cache file as a dict. The file is
+        only read again if it changed since the last time.
+        """
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return {}
+        if (stat.st_mtime_ns, stat.st_size) != self._stat:
+            try:
+                with open(self.file_name, 'r') as file_:
+                    self._data = json.load(file_)
+            except (OSError, ValueError):
+                self._data = {}
+            self._stat = (stat.st_mtime_ns, stat.st_size)
+        return self._data
+
+    def entry(self, key):
+        """Returns the entry stored under key regardless of its age."""
+        if not self.enabled:
+            return None
+        return self.load().get(key)
+
+    def get(self, key):
+        """Returns a value stored under key if it's fresh, None otherwise."""
+        entry = self.entry(key)
+        if entry is None or time.time() - entry['time'] >= self.ttl:
+            return None
+        return entry['value']
+
+    def put(self, key, value, **metadata):
+        """Stores a value and its metadata under key."""
+        if not self.enabled:
+            return
+        data = dict(self.load())
+        data[key] = dict(metadata, time=time.time(), value=value)
+        self.write(data)
+
+    def touch(self, key):
+        """Marks the value stored under key as fresh again."""
+        entry = self.entry(key)
+        if entry is not None:
+            data = dict(self.load())
+            data[key] = dict(entry, time=time.time())
+            self.write(data)
+
+    def write(self, data):
+        """Writes data to a temporary file and renames it over the cache."""
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        fd, temp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file_:
+                json.dump(data, file_)
+            os.replace(temp_name, self.file_name)
+        except:
+            os.remove(temp_name)
+            raise
+
+    def clear(self):
+        """Removes the cache file."""
+        try:
+            os.remove(self.file_name)
+        except FileNotFoundError:
+            pass
+
+def cached_get(interface, path, cache, revalidate=False):
+    """
+    Sends a get request unless a fresh response json is in the cache. A stale
+    one is revalidated with If-None-Match/If-Modified-Since and reused if the
+    server answers 304 Not Modified. Returns the json and the response, which
+    is None if no request was sent.
+    """
+    key = interface.cache_key()
+    if not revalidate:
+        json_ = cache.get(key)
+        if json_ is not None:
+            return json_, None
+    entry = cache.entry(key)
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    response = interface.get_request(path, headers=headers,
+                                     statuses=(200, 304))
+    if response.status_code == 304 and entry is not None:
+        cache.touch(key)
+        return entry['value'], response
+    json_ = response.json()
+    cache.put(key, json_,
+              etag=response.headers.get('ETag'),
+              last_modified=response.headers.get('Last-Modified'))
+    return json_, response
@@ -0,0 +1,66 @@
+"""
+This module contains helpers to transfer saves compressed with gzip or, if
+the zstandard package is installed, zstd.
+"""
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def supported_encoding(method):
+    """
+    Returns the content encoding to use for a configured compression method,
+    or None if compression is disabled. zstd falls back to gzip when the
+    zstandard package is missing.
+    """
+    method = method.lower()
+    if method in ('', 'none', 'identity'):
+        return None
+    if method == 'zstd' and zstandard is not None:
+        return 'zstd'
+    return 'gzip'
+
+def accept_encoding(encoding):
+    """Returns an Accept-Encoding header value preferring an encoding."""
+    if encoding == 'zstd':
+        return 'zstd, gzip, deflate'
+    return 'gzip, deflate'
+
+def new_compressor(encoding, level):
+    """Returns an object with compress and flush methods for an encoding."""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def compress_stream(file_, encoding, level, chunk_size=64*1024):
+    """
+    Reads a file-like object in chunks and yields them compressed, so that
+    the whole file is never held in memory.
+    """
+    compressor = new_compressor(encoding, level)
+    while True:
+        chunk = file_.read(chunk_size)
+        if not chunk:
+            break
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_decoded(response, chunk_size):
+    """
+    Yields the decoded body of a streamed response. requests decodes gzip and
+    deflate by itself, zstd is decoded here.
+    """
+    encoding = response.headers.get('Content-Encoding', '').lower()
+    if encoding == 'zstd' and zstandard is not None:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for chunk in response.raw.stream(chunk_size, decode_content=False):
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+    else:
+        yield from response.iter_content(chunk_size)
@@ -0,0 +1,103 @@
+"""
+This module contains the client's configuration. config.ini is read once per
+process; changes are written to a temporary file renamed over it while a lock
+file is held, so concurrent clients never corrupt it or lose each other's
+changes.
+"""
+
+from configparser import ConfigParser
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+file_name = "config.ini"
+parser = None # loaded on first use
+lock = threading.Lock() # serializes threads, the lock file processes
+
+def load(reload=False):
+    """Returns the config as a ConfigParser, reading the file only once."""
+    global parser
+    with lock:
+        if parser is None or reload:
+            new_parser = ConfigParser()
+            new_parser.read(file_name)
+            parser = new_parser
+        return parser
+
+def has_option(section, option):
+    """Returns whether an option is set in a section."""
+    return load().has_option(section, option)
+
+def get(section, option, fallback=None):
+    """Returns an option as a string, or fallback if it's not set."""
+    return load().get(section, option, fallback=fallback)
+
+def getint(section, option, fallback=None):
+    """Returns an option as an int, or fallback if it's not set."""
+    return load().getint(section, option, fallback=fallback)
+
+def getfloat(section, option, fallback=None):
+    """Returns an option as a float, or fallback if it's not set."""
+    return load().getfloat(section, option, fallback=fallback)
+
+def getboolean(section, option, fallback=None):
+    """Returns an option as a bool, or fallback if it's not set."""
+    return load().getboolean(section, option, fallback=fallback)
+
+@contextmanager
+def file_lock():
+    """Holds an exclusive lock on a lock file next to the config file."""
+    with open(file_name + ".lock", 'a+b') as lock_file:
+        if os.name == 'nt':
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def write(config):
+    """
+    Writes a ConfigParser to a temporary file and renames it over config. A
+    new config is readable only by its owner, as it holds the access token.
+    """
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file_:
+            config.write(file_)
+        if os.path.exists(file_name):
+            os.chmod(temp_name, os.stat(file_name).st_mode)
+        os.replace(temp_name, file_name)
+    except:
+        os.remove(temp_name)
+        raise
+
+def set_options(section, values):
+    """
+    Sets options of a section from a dict and saves the config. The file is
+    read again under the lock first, so changes made by other processes are
+    kept.
+    """
+    global parser
+    with lock, file_lock():
+        new_parser = ConfigParser()
+        new_parser.read(file_name)
+        if not new_parser.has_section(section):
+            new_parser.add_section(section)
+        for option, value in values.items():
+            new_parser[section][option] = str(value)
+        write(new_parser)
+        parser = new_parser
@@ -0,0 +1,159 @@
+"""
+This module contains a binary delta codec used to transfer a save as the
+difference from the previous save of the same game.
+
+The target is matched against fixed size blocks of the base by their adler32
+checksums. A delta consists of a header with checksums of
+the base and the target, followed by operations copying runs of base blocks
+or inserting literal bytes.
+
+Protocol: a client having a base sends its checksum in the X-Delta-Base
+header of a save-game request, and the server may answer with a delta of
+CONTENT_TYPE. Uploads post the delta to finish-turn-delta with the same
+header; a client falls back to full transfer whenever that fails.
+"""
+
+from hashlib import sha256
+import struct
+import zlib
+
+CONTENT_TYPE = 'application/x-civ5save-delta'
+MAGIC = b'C5D1'
+HEADER = struct.Struct('<4sI32s32sQ') # magic, block size, checksums, length
+COPY = struct.Struct('<cII') # b'C', first block, number of blocks
+LITERAL = struct.Struct('<cI') # b'L', length of the following bytes
+
+class DeltaMismatchError(Exception):
+    """
+    Raised when a delta doesn't apply to a base or its result doesn't match
+    the expected checksum.
+    """
+
+def checksum(data):
+    """Returns the hex sha256 checksum used to identify saves."""
+    return sha256(data).hexdigest()
+
+def signature(base, block_size):
+    """
+    Returns a dict mapping adler32 checksums of the base's full blocks to
+    lists of their indexes.
+    """
+    view = memoryview(base)
+    blocks = {}
+    for i in range(len(base) // block_size):
+        block = view[i*block_size:(i+1)*block_size]
+        blocks.setdefault(zlib.adler32(block), []).append(i)
+    return blocks
+
+def encode(base, target, block_size=4096, lookahead=4, search_blocks=16):
+    """
+    Returns a delta turning base into target. The target is matched block
+    by block against the base from the end of the last match. After a
+    mismatch, the next lookahead base blocks are searched for in the
+    following search_blocks blocks of the target, at most once per
+    search_blocks blocks, which finds local insertions, deletions and
+    changes. Anything else is sent literally, so encoding stays about as
+    fast as reading the target.
+    """
+    blocks = signature(base, block_size)
+    base_view = memoryview(base)
+    target_view = memoryview(target)
+    block_count = len(base) // block_size
+    out = [HEADER.pack(MAGIC, block_size, sha256(base).digest(),
+                       sha256(target).digest(), len(target))]
+    literal_start = 0
+    copy = None # [first block, number of blocks]
+
+    def flush_literal(end):
+        if end > literal_start:
+            out.append(LITERAL.pack(b'L', end - literal_start))
+            out.append(target_view[literal_start:end])
+
+    def flush_copy():
+        if copy is not None:
+            out.append(COPY.pack(b'C', copy[0], copy[1]))
+
+    pos = 0
+    next_block = 0 # base block expected next
+    search_start = 0 # position from which a mismatch is searched past
+    end = len(target) - block_size
+    while pos <= end:
+        window = target_view[pos:pos+block_size]
+        match = None
+        for i in blocks.get(zlib.adler32(window), ()):
+            if base_view[i*block_size:(i+1)*block_size] == window:
+                match = i
+                break
+        if match is None and pos >= search_start:
+            # Each block found narrows the search to ones found earlier
+            search_end = min(len(target),
+                             pos + (search_blocks + 1) * block_size)
+            found_at = None
+            for i in range(next_block, min(next_block + lookahead,
+                                           block_count)):
+                found = target.find(base_view[i*block_size:(i+1)*block_size],
+                                    pos + 1, search_end)
+                if found != -1:
+                    match = i
+                    found_at = found
+                    search_end = found + block_size - 1
+            if match is None:
+                # The next search is as many blocks further on in the base
+                search_start = pos + search_blocks * block_size
+                next_block += search_blocks
+            else:
+                pos = found_at
+        if match is None:
+            pos += block_size
+            continue
+        if pos > literal_start:
+            flush_copy()
+            copy = None
+            flush_literal(pos)
+        if copy is not None and copy[0] + copy[1] == match:
+            copy[1] += 1
+        else:
+            flush_copy()
+            copy = [match, 1]
+        pos += block_size
+        literal_start = pos
+        next_block = match + 1
+        search_start = pos
+    flush_copy()
+    flush_literal(len(target))
+    return b''.join(out)
+
+def apply(base, delta):
+    """
+    Returns the target encoded in a delta against base. Raises
+    DeltaMismatchError if base or the result have wrong checksums.
+    """
+    try:
+        magic, block_size, base_sum, target_sum, length = HEADER.unpack_from(
+            delta)
+    except struct.error:
+        raise DeltaMismatchError("Truncated delta")
+    if magic != MAGIC:
+        raise DeltaMismatchError("Not a delta")
+    if sha256(base).digest() != base_sum:
+        raise DeltaMismatchError("Wrong base")
+    view = memoryview(delta)
+    out = []
+    pos = HEADER.size
+    try:
+        while pos < len(delta):
+            if view[pos:pos+1] == b'C':
+                _, first, count = COPY.unpack_from(delta, pos)
+                out.append(base[first*block_size:(first+count)*block_size])
+                pos += COPY.size
+            else:
+                _, size = LITERAL.unpack_from(delta, pos)
+                pos += LITERAL.size
+                out.append(delta[pos:pos+size])
+                pos += size
+    except struct.error:
+        raise DeltaMismatchError("Truncated delta")
+    target = b''.join(out)
+    if len(target) != length or sha256(target).digest() != target_sum:
+        raise DeltaMismatchError("Wrong result")
+    return target
@@ -3,8 +3,21 @@ This module contains game initialization & listing related actions.
 """
 
 from enum import Enum
-
-from civ5client import account, saves
+import fnmatch
+
+from civ5client import config, cache_file_name, profiling, saves
+from civ5client.cache import FileCache, cached_get
+
+# The game list is reused without a request for games_cache_ttl seconds and
+# revalidated with a conditional request afterwards
+games_cache = FileCache(
+    cache_file_name("games_cache.json"),
+    ttl=config.getfloat('Client Settings', 'games_cache_ttl', fallback=10))
+civilizations_cache = FileCache(
+    cache_file_name("civilizations_cache.json"),
+    ttl=config.getfloat('Client Settings', 'civilizations_cache_ttl',
+                        fallback=24*60*60))
+catalogs = {} # civilization catalogs by Interface cache key
 
 allowed_sizes = ['DUEL', 'TINY', 'SMALL', 'STANDARD', 'LARGE', 'HUGE']
 allowed_player_types = ['HUMAN', 'AI', 'CLOSED']
@@ -32,6 +45,15 @@ class WrongMoveError(Exception):
     to do so.
     """
 
+def post_request(interface, path, json=None):
+    """
+    Sends a post request changing games on the server and drops the cached
+    game list, which is outdated afterwards.
+    """
+    response = interface.post_request(path, json)
+    games_cache.clear()
+    return response
+
 def start_new_game(interface, game_name, game_description, map_size):
     """Sends a request to start a new game."""
     if map_size not in allowed_sizes:
@@ -39,30 +61,92 @@ def start_new_game(interface, game_name, game_description, map_size):
     json = {'gameName':game_name,
             'gameDescription':game_description,
             'mapSize':map_size}
-    return interface.post_request('/games/new-game', json)
+    return post_request(interface, '/games/new-game', json)
+
+def number_games(json):
+    """Gives each game in a game list json its reference number."""
+    for i in range(len(json)):
+        json[i]['ref_number'] = i + 1
+    return json
 
-def list_games(interface):
+@profiling.timed('games.list_games')
+def list_games(interface, revalidate=False):
     """
     Sends a request to retrieve a list of games to join/currently played and 
     outputs the response json. Returns the json and response.
+    The list is cached on disk, so the request is skipped if the list is
+    fresh (the response is None then) and made conditional otherwise.
+    revalidate forces the conditional request.
     """
-    response = interface.get_request('/games/')
-    json = response.json()
-    for i in range(len(json)):
-        json[i]['ref_number'] = i + 1
-    return json, response
+    json, response = cached_get(interface, '/games/', games_cache,
+                                revalidate=revalidate)
+    return number_games(json), response
+
+async def list_games_async(async_interface, revalidate=False):
+    """Coroutine version of list_games taking an AsyncInterface."""
+    return await async_interface.run_in_executor(
+        list_games, async_interface.interface, revalidate=revalidate)
 
 def get_civilizations(interface):
     """Returns a get request to get info about acceptable civilizations."""
     return interface.get_request("/civilizations")
 
+@profiling.timed('games.civilization_catalog')
+def civilization_catalog(interface, revalidate=False):
+    """
+    Returns a dict of acceptable civilizations' json keyed by their code.
+    The catalog is kept in memory for the process and on disk for
+    civilizations_cache_ttl seconds, after which it's revalidated with its
+    ETag/Last-Modified.
+    """
+    key = interface.cache_key()
+    if revalidate or key not in catalogs:
+        json = cached_get(interface, "/civilizations", civilizations_cache,
+                          revalidate=revalidate)[0]
+        catalogs[key] = index_by(json, 'code')
+    return catalogs[key]
+
+async def civilization_catalog_async(async_interface, revalidate=False):
+    """Coroutine version of civilization_catalog taking an AsyncInterface."""
+    return await async_interface.run_in_executor(
+        civilization_catalog, async_interface.interface,
+        revalidate=revalidate)
+
 def list_civilizations(interface):
-    """Retrieves a list of acceptable civilizations from the server."""
-    json = get_civilizations(interface).json()
-    output = []
-    for civ in json:
-        output.append(civ['code'])
-    return output
+    """Retrieves a list of acceptable civilizations' codes."""
+    return list(civilization_catalog(interface))
+
+def index_by(json_list, key):
+    """
+    Returns a dict of json objects keyed by one of their fields. The first
+    object is kept when a value repeats.
+    """
+    index = {}
+    for item in json_list:
+        index.setdefault(item[key], item)
+    return index
+
+class GameIndex():
+    """
+    Lookup tables of a single game list snapshot, keyed by game id, name and
+    reference number.
+    """
+
+    def __init__(self, game_list):
+        self.game_list = game_list
+        self.ids = index_by(game_list, 'id')
+        self.names = index_by(game_list, 'name')
+        self.numbers = index_by(game_list, 'ref_number')
+
+    @classmethod
+    def from_interface(cls, interface):
+        """Creates an index of the game list retrieved from the server."""
+        return cls(list_games(interface)[0])
+
+    def matching(self, pattern):
+        """Returns the games whose name matches a glob pattern."""
+        return [game for game in self.game_list
+                if fnmatch.fnmatchcase(game['name'], pattern)]
 
 class Game():
     def __init__(self, interface, json):
@@ -71,51 +155,57 @@ class Game():
         self.id = json['id']
         self.name = json['name']
         self.turn = self.json['turnNumber']
+        self.players_by_id = index_by(json['players'], 'id')
+        self.players_by_name = index_by(json['players'], 'humanUserAccount')
+        self.players_by_number = index_by(json['players'], 'playerNumber')
         
     @classmethod
-    def from_name(cls, interface, game_name):
-        game_list = list_games(interface)[0]
+    def from_name(cls, interface, game_name, index=None):
+        if index is None:
+            index = GameIndex.from_interface(interface)
         try:
-            game_json = next(game for game in game_list
-                if game['name'] == game_name)
-        except StopIteration:
+            game_json = index.names[game_name]
+        except KeyError:
             raise InvalidNameError
         return cls(interface, game_json)
 
     @classmethod
-    def from_number(cls, interface, ref_number):
-        game_list = list_games(interface)[0]
+    def from_number(cls, interface, ref_number, index=None):
+        if index is None:
+            index = GameIndex.from_interface(interface)
         try:
-            game_json = next(game for game in game_list
-                if game['ref_number'] == ref_number)
-        except StopIteration:
+            game_json = index.numbers[ref_number]
+        except KeyError:
             raise InvalidReferenceNumberError
         return cls(interface, game_json)
 
     @classmethod
-    def from_id(cls, interface, game_id):
-        game_list = list_games(interface)[0]
+    def from_id(cls, interface, game_id, index=None):
+        if index is None:
+            index = GameIndex.from_interface(interface)
         try:
-            game_json = next(game for game in game_list
-                if game['id'] == game_id)
-        except StopIteration:
+            game_json = index.ids[game_id]
+        except KeyError:
             raise InvalidIdError
         return cls(interface, game_json)
 
     @classmethod
-    def from_any(cls, interface, value):
+    def from_any(cls, interface, value, index=None):
         """
         Initializes from a game ref number or id, and decides which was used 
-        as an argument.
+        as an argument. A GameIndex of an already retrieved game list can be
+        given to avoid requesting it again.
         """
+        if index is None:
+            index = GameIndex.from_interface(interface)
         try:
             number = int(value)
-            return cls.from_number(interface, number)
+            return cls.from_number(interface, number, index)
         except (ValueError, TypeError):
             try:
-                return cls.from_name(interface, value)
+                return cls.from_name(interface, value, index)
             except InvalidNameError:
-                return cls.from_id(interface, value)
+                return cls.from_id(interface, value, index)
 
     def info(self):
         """Returns game json."""
@@ -123,12 +213,12 @@ class Game():
 
     def find_own_player_id(self):
         """Finds player-id connected to the interface."""
-        username = account.request_credentials(self.interface).json()['username']
+        username = self.interface.get_credentials()['username']
         return Player.from_name(self, username).id
 
     def find_own_player_number(self):
         """Returns the number of the currently moving player."""
-        username = account.request_credentials(self.interface).json()['username']
+        username = self.interface.get_credentials()['username']
         return Player.from_name(self, username).number
 
     def to_move(self, can_host=True):
@@ -136,7 +226,7 @@ class Game():
         Returns whether the player connected to the interface is supposed to do
         the next move.
         """
-        username = account.request_credentials(self.interface).json()['username']
+        username = self.interface.get_credentials()['username']
         if self.json['currentlyMovingPlayer'] == username:
             return True 
         elif (self.json['host'] == username 
@@ -187,16 +277,15 @@ class Game():
 
     def join(self):
         """Requests to join the game with the current account."""
-        return self.interface.post_request(
-            '/games/'+self.id+'/join')
+        return post_request(self.interface, '/games/'+self.id+'/join')
 
     def leave(self):
         """Requests to leave a game with the current account."""
-        return self.interface.post_request("/games/"+self.id+"/leave")
+        return post_request(self.interface, "/games/"+self.id+"/leave")
     
     def start(self):
         """Requests to start a game."""
-        return self.interface.post_request("/games/"+self.id+"/start")
+        return post_request(self.interface, "/games/"+self.id+"/start")
 
     def download(self, force=False, bar=False):
         """Downloads the save if it's your turn."""
@@ -205,16 +294,33 @@ class Game():
         else:
             raise WrongMoveError
 
-    def upload(self, bar=False):
+    def prefetch(self):
+        """
+        Starts prefetching the save in the background if it's your turn.
+        Returns the thread, or None if it's not your turn.
+        """
+        if self.to_move(can_host=False):
+            return saves.prefetch_save(self)
+        return None
+
+    async def download_async(self, async_interface, force=False, bar=False):
+        """Coroutine version of download run by an AsyncInterface."""
+        return await async_interface.run_in_executor(
+            self.download, force=force, bar=bar)
+
+    def upload(self, file_name=None, bar=False):
         """Uploads the save and finishes the turn."""
         if self.to_move():
-            return saves.upload_save(self, bar=bar)
+            output = saves.upload_save(self, file_name=file_name, bar=bar)
+            games_cache.clear()
+            return output
         else:
             raise WrongMoveError
 
     def disable_validation(self):
         """Sends a request to disable validaton."""
-        return self.interface.post_request("/games/"+self.id+"/disable-validation")
+        return post_request(self.interface,
+                            "/games/"+self.id+"/disable-validation")
 
 class Player():
     def __init__(self, game, json):
@@ -227,25 +333,22 @@ class Player():
     @classmethod
     def from_name(cls, game, name):
         try:
-            return cls(game, next(player for player in game.json['players']
-                if player['humanUserAccount'] == name))
-        except StopIteration:
+            return cls(game, game.players_by_name[name])
+        except KeyError:
             raise InvalidNameError
 
     @classmethod
     def from_number(cls, game, number):
         try:
-            return cls(game, next(player for player in game.json['players']
-                if player['playerNumber'] == number))
-        except StopIteration:
+            return cls(game, game.players_by_number[number])
+        except KeyError:
             raise InvalidReferenceNumberError
 
     @classmethod
     def from_id(cls, game, player_id):
         try:
-            return cls(game, next(player for player in game.json['players']
-                if player['id'] == player_id))
-        except StopIteration:
+            return cls(game, game.players_by_id[player_id])
+        except KeyError:
             raise InvalidIdError
 
     @classmethod
@@ -269,21 +372,20 @@ class Player():
         if player_type not in allowed_player_types:
             raise ValueError("Wrong player type")
         json = {'playerType':player_type}
-        return self.interface.post_request("/games/"+self.game.id+
-                                           "/players/"+self.id+
-                                           "/change-player-type", json)
+        return post_request(self.interface, "/games/"+self.game.id+
+                                            "/players/"+self.id+
+                                            "/change-player-type", json)
 
     def choose_civilization(self, civilization):
-        allowed_civs = list_civilizations(self.interface)
         civilization = civilization.upper()
-        if civilization not in allowed_civs:
+        if civilization not in civilization_catalog(self.interface):
             raise ValueError("Civilization not allowed")
         json = {'civilization':civilization}
-        return self.interface.post_request("/games/"+self.game.id+
-                                           "/players/"+self.id+
-                                           "/choose-civilization", json)
+        return post_request(self.interface, "/games/"+self.game.id+
+                                            "/players/"+self.id+
+                                            "/choose-civilization", json)
 
     def kick(self):
-        return self.interface.post_request("/games/"+self.game.id+
-                                           "/players/"+player.id+
-                                           "/kick")
+        return post_request(self.interface, "/games/"+self.game.id+
+                                            "/players/"+player.id+
+                                            "/kick")
@@ -0,0 +1,114 @@
+"""
+This module contains polling the server to notice when it becomes the
+player's turn in any game.
+"""
+
+from sys import platform
+import random
+import shlex
+import shutil
+import subprocess
+import time
+
+from civ5client import config, games, saves, ServerError
+
+# Polling starts at min_interval seconds and backs off to max_interval
+# while nothing changes
+min_interval = config.getfloat('Client Settings', 'poll_min_interval',
+                               fallback=30)
+max_interval = config.getfloat('Client Settings', 'poll_max_interval',
+                               fallback=600)
+# Command run without a shell when it's the player's turn; its arguments are
+# formatted with {name}, {id} and {turn} of the game. Desktop notifications
+# are used if empty
+notify_command = config.get('Client Settings', 'notify_command', fallback='')
+
+def game_states(game_list):
+    """Returns the moving player and turn number of games by their id."""
+    return {game['id']:(game['currentlyMovingPlayer'], game['turnNumber'])
+            for game in game_list}
+
+def next_interval(interval, changed, min_interval=min_interval,
+                  max_interval=max_interval):
+    """
+    Returns the next polling interval: the minimum after a change, twice
+    the last one otherwise, up to the maximum.
+    """
+    if changed:
+        return min_interval
+    return min(interval * 2, max_interval)
+
+def jitter(interval, spread=0.2):
+    """Randomizes an interval by up to spread of it either way."""
+    return interval * random.uniform(1 - spread, 1 + spread)
+
+def poll_turns(interface, min_interval=min_interval,
+               max_interval=max_interval, sleep=time.sleep, on_error=None):
+    """
+    Polls the game list with one conditional request per cycle, backing off
+    while nothing changes. Yields lists of Games whose moving player or turn
+    changed and in which the player is to move; the first cycle yields all
+    games in which the player is to move. Prefetched saves of earlier moves
+    of changed games are removed if saves are prefetched.
+    A failed request doesn't stop polling: it's passed to on_error if given
+    and polling backs off as if nothing changed.
+    """
+    import requests
+    previous = {}
+    interval = min_interval
+    while True:
+        try:
+            game_list = games.list_games(interface, revalidate=True)[0]
+        except (requests.exceptions.RequestException, ServerError) as e:
+            if on_error is not None:
+                on_error(e)
+            interval = next_interval(interval, False, min_interval,
+                                     max_interval)
+            sleep(jitter(interval))
+            continue
+        states = game_states(game_list)
+        changed = states != previous
+        turns = []
+        for game_json in game_list:
+            if states[game_json['id']] != previous.get(game_json['id']):
+                game = games.Game(interface, game_json)
+                if saves.prefetch_saves:
+                    saves.clean_prefetches(game)
+                if game.to_move():
+                    turns.append(game)
+        previous = states
+        yield turns
+        interval = next_interval(interval, changed, min_interval,
+                                 max_interval)
+        sleep(jitter(interval))
+
+def notify_arguments(game, command=notify_command):
+    """
+    Returns the arguments of a notify command for a game. The command is
+    split like a command line before the game's values are put in, so a game
+    name can't add arguments or commands of its own.
+    """
+    return [argument.format(name=game.name, id=game.id, turn=game.turn)
+            for argument in shlex.split(command, posix=platform != "win32")]
+
+def notify(game, on_error=None):
+    """
+    Runs notify_command for a game in which it's the player's turn, or shows
+    a desktop notification if no command is configured. A command that can't
+    be formatted or run doesn't stop polling: the error is passed to on_error
+    if given.
+    """
+    try:
+        if notify_command:
+            subprocess.run(notify_arguments(game, notify_command))
+            return
+        message = "Your turn in {} (turn {})".format(game.name, game.turn)
+        if platform == "darwin":
+            subprocess.run(['osascript', '-e',
+                            'display notification "{}" with title "civ5-pbem"'
+                            .format(message.replace('"', "'"))])
+        elif shutil.which('notify-send'):
+            subprocess.run(['notify-send', 'civ5-pbem', message])
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        if on_error is not None:
+            on_error(e)
@@ -0,0 +1,184 @@
+"""
+This module contains recording where the time of a command goes: timings of
+requests sent by an Interface and timed spans around parsing and save
+transfers. Nothing is recorded unless profiling is enabled.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+import threading
+import time
+import weakref
+
+enabled = False
+started = time.perf_counter() # times are relative to the import
+request_timings = []
+spans = []
+lock = threading.Lock()
+local = threading.local() # stack of open span names of each thread
+streams = weakref.WeakKeyDictionary() # timings of streamed responses
+
+class RequestTiming():
+    """
+    Timing of a request. ttfb is the time from sending the request until the
+    response headers were parsed, including name resolution and connecting,
+    which requests doesn't expose separately. transfer is the time the body
+    took to arrive after that. Times are in seconds.
+    """
+
+    def __init__(self, method, path, status, start, ttfb, sent):
+        self.method = method
+        self.path = path
+        self.status = status
+        self.start = start
+        self.ttfb = ttfb
+        self.transfer = None
+        self.sent = sent
+        self.received = None
+
+    def as_json(self):
+        return dict(vars(self))
+
+class Span():
+    """Time spent in a named phase, nested depth spans deep in its thread."""
+
+    def __init__(self, name, depth, start, seconds):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.seconds = seconds
+
+    def as_json(self):
+        return dict(vars(self))
+
+def enable():
+    """Starts recording."""
+    global enabled
+    enabled = True
+
+def body_size(body):
+    """Returns the size of a request body, or None if it's streamed."""
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return None
+
+def record_request(method, path, response, start, stream=False):
+    """
+    Records a request sent at start by time.perf_counter. The transfer of a
+    streamed response is recorded later by record_transfer.
+    """
+    if not enabled:
+        return
+    now = time.perf_counter()
+    ttfb = response.elapsed.total_seconds()
+    sent = body_size(response.request.body)
+    if sent is None and 'Content-Length' in response.request.headers:
+        sent = int(response.request.headers['Content-Length'])
+    timing = RequestTiming(method, path, response.status_code,
+                           start - started, ttfb, sent)
+    if stream:
+        streams[response] = (timing, now)
+    else:
+        timing.transfer = max(0.0, now - start - ttfb)
+        timing.received = len(response.content)
+    with lock:
+        request_timings.append(timing)
+
+def record_transfer(response, received):
+    """Records the end of the transfer of a streamed response's body."""
+    if not enabled or response not in streams:
+        return
+    timing, headers_received = streams.pop(response)
+    timing.transfer = time.perf_counter() - headers_received
+    timing.received = received
+
+@contextmanager
+def span(name):
+    """
+    Context manager recording the time spent inside it under a name. Spans
+    may be nested.
+    """
+    if not enabled:
+        yield
+        return
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+        stack = local.stack = []
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        with lock:
+            spans.append(Span(name, len(stack), start - started, seconds))
+
+def timed(name):
+    """Decorator recording each call of a function as a span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def phases():
+    """
+    Returns spans summed by name and depth, in the order they were first
+    entered, as dicts of name, depth, calls and seconds.
+    """
+    summary = OrderedDict()
+    with lock:
+        recorded = sorted(spans, key=lambda span_: span_.start)
+    for span_ in recorded:
+        key = (span_.depth, span_.name)
+        if key not in summary:
+            summary[key] = {'name':span_.name, 'depth':span_.depth,
+                            'calls':0, 'seconds':0.0}
+        summary[key]['calls'] += 1
+        summary[key]['seconds'] += span_.seconds
+    return list(summary.values())
+
+def report():
+    """Returns everything recorded as json."""
+    with lock:
+        request_list = [timing.as_json() for timing in request_timings]
+        span_list = [span_.as_json() for span_ in spans]
+    return {'seconds':time.perf_counter() - started,
+            'phases':phases(),
+            'request_count':len(request_list),
+            'bytes_sent':sum(timing['sent'] or 0 for timing in request_list),
+            'bytes_received':sum(timing['received'] or 0
+                                 for timing in request_list),
+            'requests':request_list,
+            'spans':span_list}
+
+def format_report(data):
+    """Returns json made by report as readable text."""
+    lines = ["Profile: {:.3f} s in total".format(data['seconds'])]
+    if data['phases']:
+        lines.append("Phases:")
+    for phase in data['phases']:
+        lines.append("  {:44} {:5} calls {:9.3f} s".format(
+            "  " * phase['depth'] + phase['name'], phase['calls'],
+            phase['seconds']))
+    lines.append("Requests: {} ({} bytes sent, {} bytes received)".format(
+        data['request_count'], data['bytes_sent'], data['bytes_received']))
+    for timing in data['requests']:
+        transfer = timing['transfer']
+        lines.append("  {:4} {:38} {:3} ttfb {:7.3f} s transfer {} "
+                     "{} B".format(
+                         timing['method'], timing['path'], timing['status'],
+                         timing['ttfb'],
+                         "{:7.3f} s".format(transfer) if transfer is not None
+                         else "      ? s",
+                         timing['received'] if timing['received'] is not None
+                         else "?"))
+    return "\n".join(lines)
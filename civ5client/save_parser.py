@@ -11,89 +11,330 @@ information, such as whose turn it is or if anyone lost.
 # TODO:
 # time played - compressed
 
-from bitstring import ConstBitStream
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from civ5client import profiling
+from civ5client.cache import FileCache
+
+BLOCK_MARKER = b'\x40\x00\x00\x00'
+ZLIB_HEADER = b'\x78\x9c'
+INFLATE_CHUNK_SIZE = 64*1024
+# Bytes after a zlib header that must inflate cleanly for it to be taken for
+# the start of the game data
+ZLIB_CHECK_SIZE = 64*1024
+
+def inflate(data, offset, chunk_size=INFLATE_CHUNK_SIZE):
+    """
+    Yields decompressed chunks of at most chunk_size bytes of a zlib stream
+    starting at offset in data, reading only as much input as needed.
+    """
+    decompressor = zlib.decompressobj()
+    position = offset
+    while not decompressor.eof:
+        if decompressor.unconsumed_tail:
+            chunk = decompressor.decompress(decompressor.unconsumed_tail,
+                                            chunk_size)
+        elif position < len(data):
+            chunk = decompressor.decompress(
+                data[position:position+chunk_size], chunk_size)
+            position += chunk_size
+        else:
+            break
+        if chunk:
+            yield chunk
 
 class SaveReader():
-    """Class designed to retrieve basic data from files."""
+    """
+    Class designed to retrieve basic data from files. The file is mapped
+    into memory and read byte-wise; pos is the current offset in bytes.
+    """
 
     def __init__(self, file_name):
-        self.file = open(file_name, 'r')
-        self.stream = ConstBitStream(self.file)
+        self.file = open(file_name, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+        self.blocks = [] # offsets of the blocks found so far
 
     def __enter__(self):
         return self
 
     def __exit__(self, type_, value, traceback):
+        self.data.close()
         self.file.close()
 
     def read_bytes(self, count):
-        """Read a number of bytes and return a bitstring."""
-        return self.stream.read(count*8)
+        """Read a number of bytes and return them."""
+        out = self.data[self.pos:self.pos+count]
+        self.pos += count
+        return out
+
+    def find_block(self, index):
+        """
+        Find the offset of a data block, scanning the file only up to it.
+        Raises IndexError if there are fewer blocks.
+        """
+        while len(self.blocks) <= index:
+            start = 0
+            if self.blocks:
+                start = self.blocks[-1] + len(BLOCK_MARKER)
+            position = self.data.find(BLOCK_MARKER, start)
+            if position == -1:
+                raise IndexError("No block {} in save".format(index))
+            self.blocks.append(position)
+        return self.blocks[index]
 
     def find_blocks(self):
         """Find all data blocks and return a tuple of their offsets."""
-        return tuple(self.stream.findall('0x40000000', bytealigned=True))
+        try:
+            while True:
+                self.find_block(len(self.blocks))
+        except IndexError:
+            return tuple(self.blocks)
+
+    def find_compressed(self, check_size=ZLIB_CHECK_SIZE):
+        """
+        Find the offset of the zlib stream holding the game data, which
+        follows the data blocks. The header bytes also occur by chance in
+        other data, so a header is only taken if the check_size bytes after
+        it inflate without errors, or the stream ends cleanly before.
+        """
+        position = self.data.find(ZLIB_HEADER, self.find_block(11))
+        while position != -1:
+            decompressor = zlib.decompressobj()
+            tail = self.data[position:position+check_size]
+            try:
+                while tail and not decompressor.eof:
+                    decompressor.decompress(tail, INFLATE_CHUNK_SIZE)
+                    tail = decompressor.unconsumed_tail
+                return position
+            except zlib.error:
+                position = self.data.find(ZLIB_HEADER, position + 1)
+        raise ValueError("No compressed data in save")
 
     def read_int(self):
         """Read a 4 byte little endian int."""
-        return self.stream.read(32).intle
+        value, = struct.unpack_from('<i', self.data, self.pos)
+        self.pos += 4
+        return value
 
     def read_ints(self, count):
         """Return a tuple of ints."""
-        return tuple(map(lambda x: x.read(32).intle, 
-                         self.read_bytes(count*4).cut(32)))
+        values = struct.unpack_from('<{}i'.format(count), self.data, self.pos)
+        self.pos += 4 * count
+        return values
 
     def read_string(self):
         """Read a string with the length given in the first 4 bytes."""
-        return self.stream.read(
-            'bytes:{}'.format(self.read_int())).decode("utf-8", 'replace')
+        return self.read_bytes(self.read_int()).decode("utf-8", 'replace')
         
-def parse_file(file_name):
+def read_turn(sr):
+    """Reads the current turn from the header."""
+    sr.pos = 8
+    sr.read_string()
+    sr.read_string()
+    return {'turn':sr.read_int()}
+
+def read_players(sr):
+    """Reads which players are dead and the first and last human player."""
+    sr.pos = sr.find_block(2) + 4
+    player_statuses = sr.read_ints(22) # Maximum number is 22 players
+    # 1 is AI
+    # 2 is Dead/Closed
+    # 3 is Human
+    # 4 is Missing, i.e. too small map
+    dead_players = tuple(map(lambda x: x == 2, player_statuses))
+
+    first_player = None
+    last_player = None
+    for i in range(len(player_statuses)):
+        if player_statuses[i] == 3:
+            if first_player is None:
+                first_player = i
+            last_player = i
+    return {'dead_players':dead_players,
+            'first_player':first_player,
+            'last_player':last_player}
+
+def read_current_player(sr):
+    """Reads the number of the current player."""
+    sr.pos = sr.find_block(8) - 4 * 4
+    return {'current':sr.read_int()}
+
+def read_password_list(sr):
+    """Reads the list of who has a password."""
+    sr.pos = sr.find_block(11) + 4
+    password_list = [False] * 22
+    for i in range(22):
+        if sr.read_string():
+            password_list[i] = True
+    return {'password_list':password_list}
+
+# Fields of parse_file output and the functions reading them
+field_readers = {
+    'turn':read_turn,
+    'current':read_current_player,
+    'password_list':read_password_list,
+    'dead_players':read_players,
+    'first_player':read_players,
+    'last_player':read_players}
+fields = tuple(field_readers)
+
+def iter_compressed(file_name, chunk_size=INFLATE_CHUNK_SIZE):
+    """Yields decompressed chunks of the game data of a save."""
+    with SaveReader(file_name) as sr:
+        yield from inflate(sr.data, sr.find_compressed(), chunk_size)
+
+def iter_fields(file_name, fields=fields):
+    """
+    Yields pairs of field names and values of a save one by one, so that
+    reading can stop once the needed fields are read.
+    """
+    values = {}
+    with SaveReader(file_name) as sr:
+        for field in fields:
+            if field not in values:
+                values.update(field_readers[field](sr))
+            yield field, values[field]
+
+@profiling.timed('save_parser.parse_file')
+def parse_file(file_name, fields=fields):
     """
     Parses savefile and returns the turn number, current player number, 
     number of set passwords and the number of dead players.
+    Only the given fields are read, and the file is scanned only as far as
+    they require.
     """
-    with SaveReader(file_name) as sr:
-        # Current turn
-        sr.stream.pos = 64
-        sr.read_string()
-        sr.read_string()
-        current_turn = sr.read_int()
-
-        block_positions = sr.find_blocks()
-        # Number of players
-        sr.stream.pos = block_positions[2] + 32
-        player_statuses = sr.read_ints(22) # Maximum number is 22 players
-        # 1 is AI
-        # 2 is Dead/Closed
-        # 3 is Human
-        # 4 is Missing, i.e. too small map
-        dead_players = tuple(map(lambda x: x == 2, player_statuses))
-
-        first_player = None
-        last_player = None
-        for i in range(len(player_statuses)):
-            if player_statuses[i] == 3:
-                if first_player is None:
-                    first_player = i
-                last_player = i
-    
-        # Current player
-        sr.stream.pos = block_positions[8] - 32 * 4
-        current_player = sr.read_int()
-
-        # List of who has a password
-        sr.stream.pos = block_positions[11] + 32
-        password_list = [False] * 22
-        for i in range(22):
-            if sr.read_string():
-                password_list[i] = True
-
-    out_dict = {
-        'turn':current_turn,
-        'current':current_player,
-        'password_list':password_list,
-        'dead_players':dead_players,
-        'first_player':first_player,
-        'last_player':last_player}
-    return out_dict
+    return dict(iter_fields(file_name, fields))
+
+def metadata_from_json(json):
+    """Turns parse_file output read back from json into its original form."""
+    metadata = dict(json)
+    if 'dead_players' in metadata:
+        metadata['dead_players'] = tuple(metadata['dead_players'])
+    return metadata
+
+class SaveMetadata():
+    """
+    Cache of parse_file results keyed by path, size and modification time,
+    so that an unchanged save is parsed only once. If index_name is given,
+    the results are also kept in that json file for later processes. It can
+    be shared by threads.
+    """
+
+    def __init__(self, index_name=None):
+        self.entries = {}
+        self.changed = set() # paths of entries not written to the index yet
+        self.index = FileCache(index_name) if index_name else None
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(file_name):
+        """Returns the absolute path, size and mtime in ns of a file."""
+        stat = os.stat(file_name)
+        return os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, file_name):
+        """Returns cached parse_file output of a save or None."""
+        path, size, mtime_ns = self.key(file_name)
+        entry = self.entries.get(path)
+        if entry is None and self.index is not None:
+            entry = self.index.entry(path)
+        if (entry is None or entry['size'] != size
+                or entry['mtime_ns'] != mtime_ns):
+            return None
+        self.entries[path] = entry
+        return metadata_from_json(entry['value'])
+
+    def store(self, file_name, metadata, write=True):
+        """
+        Caches parse_file output of a save. With write set to False the
+        index isn't written until write_index is called.
+        """
+        path, size, mtime_ns = self.key(file_name)
+        with self.lock:
+            self.entries[path] = {'time':time.time(), 'value':metadata,
+                                  'size':size, 'mtime_ns':mtime_ns}
+            self.changed.add(path)
+            if write:
+                self.write_index()
+
+    def write_index(self):
+        """Writes entries stored since the last write to the index file."""
+        with self.lock:
+            if self.index is not None and self.changed:
+                # Saves that no longer exist are dropped from the index
+                data = {key:value for key, value in self.index.load().items()
+                        if os.path.exists(key)}
+                for path in self.changed:
+                    data[path] = self.entries[path]
+                self.index.write(data)
+            self.changed = set()
+
+    def get(self, file_name, fields=fields):
+        """
+        Returns the given fields of parse_file output of a save, parsing
+        only those not cached for its current version.
+        """
+        metadata = self.lookup(file_name) or {}
+        missing = [field for field in fields if field not in metadata]
+        if missing:
+            metadata.update(parse_file(file_name, missing))
+            self.store(file_name, metadata)
+        return {field:metadata[field] for field in fields}
+
+def try_parse_file(file_name, fields=fields):
+    """
+    Returns parse_file output and None, or None and an error message if the
+    save can't be parsed.
+    """
+    try:
+        return parse_file(file_name, fields), None
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+def parse_files(file_names, fields=fields, metadata=None, workers=None,
+                mp_context=None):
+    """
+    Parses many saves in a pool of worker processes and yields tuples of a
+    file name, its parse_file output and an error message (None if
+    successful) in the given order. Saves cached unchanged in metadata, a
+    SaveMetadata, aren't parsed again. With workers set to 0 saves are
+    parsed in the current process.
+    """
+    file_names = list(file_names)
+    cached = {}
+    to_parse = []
+    for file_name in file_names:
+        value = metadata.lookup(file_name) if metadata is not None else None
+        if value is not None and all(field in value for field in fields):
+            cached[file_name] = {field:value[field] for field in fields}
+        else:
+            to_parse.append(file_name)
+
+    def output(results):
+        for file_name in file_names:
+            if file_name in cached:
+                yield file_name, cached[file_name], None
+                continue
+            value, error = next(results)
+            if value is not None and metadata is not None:
+                metadata.store(file_name, value, write=False)
+            yield file_name, value, error
+        if metadata is not None:
+            metadata.write_index()
+
+    if workers == 0 or len(to_parse) < 2:
+        yield from output(map(try_parse_file, to_parse, repeat(fields)))
+        return
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, len(to_parse) // (workers * 4))
+    with ProcessPoolExecutor(workers, mp_context=mp_context) as executor:
+        yield from output(executor.map(try_parse_file, to_parse,
+                                       repeat(fields), chunksize=chunk_size))
@@ -2,17 +2,41 @@
 This module contains savefile download/upload related actions.
 """
 
-from configparser import ConfigParser
+from collections import namedtuple
 from sys import platform
 import glob
+import io
+import json
 import re
-import shutil
 import os
+import tempfile
+import threading
+import time
 from os.path import expanduser
 
-from tqdm import tqdm
+from civ5client import (ServerError, InvalidConfigurationError, config,
+                        cache_file_name, save_parser, compression, delta,
+                        profiling, NoProgressBar)
 
-from civ5client import ServerError, InvalidConfigurationError, config_file_name, save_parser
+# Size of chunks in which saves are downloaded and written
+download_chunk_size = config.getint('Client Settings', 'download_chunk_size',
+                                    fallback=256*1024)
+# Number of times an interrupted download is resumed before giving up
+download_retries = config.getint('Client Settings', 'download_retries',
+                                 fallback=3)
+# Whether saves are transferred as deltas from the last save exchanged in a
+# game, which is kept in delta_base_dir
+delta_transfer = config.getboolean('Client Settings', 'delta_transfer',
+                                   fallback=False)
+delta_base_dir = cache_file_name("delta_bases")
+# Whether parsed save metadata is kept in an index file in the save directory
+metadata_index = config.getboolean('Saves', 'metadata_index', fallback=True)
+metadata_index_name = ".civ5client-index.json"
+metadata_caches = {}
+# Whether poll downloads saves in the background once it's the player's turn,
+# into prefetch_dir_name in the save directory
+prefetch_saves = config.getboolean('Saves', 'prefetch', fallback=False)
+prefetch_dir_name = ".prefetch"
 
 class UnknownOperatingSystemError(Exception):
     """
@@ -23,6 +47,22 @@ class UnknownOperatingSystemError(Exception):
 class MissingSaveFileError(Exception):
     """Raised when a save file is missing for upload."""
 
+class IncompleteDownloadError(Exception):
+    """
+    Raised when a download ends before the whole save is received. The
+    received part is kept to be resumed.
+    """
+
+class TransferStats(namedtuple('TransferStats', ['size', 'seconds'])):
+    """Number of bytes transferred and the time it took."""
+
+    @property
+    def throughput(self):
+        """Returns the average number of bytes per second, 0 if untimed."""
+        if self.seconds <= 0:
+            return 0.0
+        return self.size / self.seconds
+
 def get_default_save_path():
     """Returns the default save path for the user based on the os."""
     # TODO: Confirm it's working, especially on windows
@@ -38,11 +78,8 @@ def get_default_save_path():
 
 def get_config_save_path():
     """Returns the save path from config."""
-    config = ConfigParser()
-    config.read(config_file_name)
-    if (config.has_section('Saves')
-            and config.has_option('Saves', 'save_path')):
-        path = config['Saves']['save_path']
+    if config.has_option('Saves', 'save_path'):
+        path = config.get('Saves', 'save_path')
         if not path.endswith("/") and platform != "win32":
             path = path + "/"
         elif not path.endswith("\\") and platform == "win32":
@@ -53,35 +90,281 @@ def get_config_save_path():
 
 def save_save_path_config(path):
     """Writes save path location to a selected config file."""
-    config = ConfigParser()
-    config.read(config_file_name)
-    if not config.has_section('Saves'):
-        config.add_section('Saves')
-    config['Saves']['save_path'] = path
-    with open(config_file_name, 'w') as config_file:
-        config.write(config_file)
+    config.set_options('Saves', {'save_path':path})
+
+def delta_base_name(game):
+    """Returns the path of the last save exchanged in a game."""
+    return os.path.join(delta_base_dir, game.id+".Civ5Save")
+
+def read_delta_base(game):
+    """Returns the last save exchanged in a game, or None if there's none."""
+    try:
+        with open(delta_base_name(game), 'rb') as file_:
+            return file_.read()
+    except OSError:
+        return None
 
-def download_save(game, bar=False):
+@profiling.timed('saves.store_delta_base')
+def store_delta_base(game, file_name):
+    """Keeps a copy of a save as the base for the game's next delta."""
+    os.makedirs(delta_base_dir, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=delta_base_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file, open(file_name, 'rb') as file_:
+            while True:
+                chunk = file_.read(download_chunk_size)
+                if not chunk:
+                    break
+                temp_file.write(chunk)
+        os.replace(temp_name, delta_base_name(game))
+    except:
+        os.remove(temp_name)
+        raise
+
+def get_save_metadata(path=None):
     """
-    Downloads a game savefile from the server and saves it into the
-    civilization 5 save directory from config. 
-    Returns the name of the file.
-    """
-    file_name = "temp_save.Civ5Save"
-    with open(file_name, 'wb') as file_:
-        response = game.interface.get_request("/games/"+game.id+"/save-game",
-                                 stream=True)
-        iterator = response.iter_content()
+    Returns the SaveMetadata cache for a save directory, by default the one
+    from config.
+    """
+    if path is None:
+        path = get_config_save_path()
+    if path not in metadata_caches:
+        index_name = None
+        if metadata_index:
+            index_name = os.path.join(path, metadata_index_name)
+        # Another thread may have created it meanwhile
+        metadata_caches.setdefault(path, save_parser.SaveMetadata(index_name))
+    return metadata_caches[path]
+
+@profiling.timed('saves.read_save')
+def read_save(file_name, fields=save_parser.fields):
+    """
+    Returns the given fields of parse_file output of a save, parsing it only
+    if it changed.
+    """
+    return get_save_metadata(os.path.dirname(file_name)).get(file_name,
+                                                             fields)
+
+def partial_download_names(path):
+    """
+    Returns the names of the partial file and its metadata file used while
+    downloading a save to path.
+    """
+    return path+".part", path+".part.json"
+
+def read_partial_download(path):
+    """
+    Returns the size and metadata of a resumable partial download of a save
+    to path, or 0 and None if there is none.
+    """
+    part_name, meta_name = partial_download_names(path)
+    try:
+        with open(meta_name, 'r') as meta_file:
+            meta = json.load(meta_file)
+        return os.path.getsize(part_name), meta
+    except (OSError, ValueError):
+        return 0, None
+
+def remove_partial_download(path):
+    """Removes the partial file and metadata of a download to path."""
+    for name in partial_download_names(path):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+@profiling.timed('saves.fetch_save')
+def fetch_save(game, path, bar=False, chunk_size=download_chunk_size,
+               base=None):
+    """
+    Makes a single attempt to download the save to path. A partial file left
+    by an earlier attempt is resumed with a Range request, validated with
+    If-Range; if the server sends the whole save instead, it's downloaded
+    from the start. Otherwise a compressed response is accepted if
+    compression is configured, and a delta from base if one is given. A
+    compressed response that ends early raises IncompleteDownloadError too,
+    but is downloaded again from the start. Returns the response and the
+    number of bytes received.
+    """
+    part_name, meta_name = partial_download_names(path)
+    offset, meta = read_partial_download(path)
+    validator = meta and (meta['etag'] or meta['last_modified'])
+    # Ranges and lengths refer to the unencoded save, so the gzip requests
+    # accepts by default is refused unless compression is configured
+    headers = {'Accept-Encoding':'identity'}
+    if offset and validator:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        headers['If-Range'] = validator
+    else:
+        if game.interface.download_encoding:
+            headers['Accept-Encoding'] = compression.accept_encoding(
+                game.interface.download_encoding)
+        if base is not None:
+            headers['X-Delta-Base'] = delta.checksum(base)
+    response = game.interface.get_request("/games/"+game.id+"/save-game",
+                                          stream=True, headers=headers,
+                                          statuses=(200, 206, 416))
+    encoded_length = None
+    with response:
+        if response.headers.get('Content-Type') == delta.CONTENT_TYPE:
+            data = response.content
+            remove_partial_download(path)
+            profiling.record_transfer(response, len(data))
+            with open(part_name, 'wb') as file_:
+                file_.write(delta.apply(base, data))
+            os.replace(part_name, path)
+            return response, len(data)
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code == 416 or (
+                response.status_code == 206
+                and not content_range.startswith('bytes {}-'.format(offset))):
+            remove_partial_download(path)
+            raise IncompleteDownloadError("Unusable range response")
+        if response.status_code == 206:
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+            # The length of an encoded save is unknown until it's decoded,
+            # so the encoded body read is checked against Content-Length
+            length = response.headers.get('Content-Length')
+            if 'Content-Encoding' in response.headers:
+                encoded_length = int(length) if length else None
+                length = None
+            etag = response.headers.get('ETag')
+            meta = {'length':int(length) if length else None,
+                    'etag':etag if etag and not etag.startswith('W/') else None,
+                    'last_modified':response.headers.get('Last-Modified')}
+            remove_partial_download(path)
+            if meta['length'] is not None:
+                with open(meta_name, 'w') as meta_file:
+                    json.dump(meta, meta_file)
         if bar:
-            iterator = tqdm(iterator, desc="Downloading",
-                            total=int(response.headers['Content-Length']),
-                            unit_scale=True)
-        for chunk in iterator:
-            file_.write(chunk)
-    final_name = game.name+" "+str(game.turn)+".Civ5Save"
-    path = get_config_save_path()+final_name
-    shutil.move(file_name, path) # May throw OSError if already exists on windows
-    return path, response
+            from tqdm import tqdm
+            progress = tqdm(desc="Downloading", unit='B', unit_scale=True,
+                            total=meta['length'], initial=offset)
+        else:
+            progress = NoProgressBar()
+        received = 0
+        with open(part_name, mode) as file_, progress:
+            for chunk in compression.iter_decoded(response, chunk_size):
+                file_.write(chunk)
+                received += len(chunk)
+                progress.update(len(chunk))
+        profiling.record_transfer(response, received)
+        if (encoded_length is not None
+                and response.raw.tell() < encoded_length):
+            raise IncompleteDownloadError(response.raw.tell(), encoded_length)
+    if meta['length'] is not None and offset + received < meta['length']:
+        raise IncompleteDownloadError(offset + received, meta['length'])
+    os.replace(part_name, path)
+    remove_partial_download(path)
+    return response, received
+
+@profiling.timed('saves.fetch_save_with_retries')
+def fetch_save_with_retries(game, path, bar=False,
+                            chunk_size=download_chunk_size,
+                            retries=download_retries):
+    """
+    Downloads the save to path with fetch_save, resuming an interrupted
+    download up to retries times. With delta_transfer the save may arrive as
+    a delta from the last save exchanged in the game; if it doesn't apply,
+    the whole save is requested. Returns the response and TransferStats of
+    the last attempt.
+    """
+    import requests
+    base = read_delta_base(game) if delta_transfer else None
+    for attempt in range(retries+1):
+        start = time.perf_counter()
+        try:
+            response, size = fetch_save(game, path, bar=bar,
+                                        chunk_size=chunk_size, base=base)
+        except delta.DeltaMismatchError:
+            if attempt == retries:
+                raise
+            base = None
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                IncompleteDownloadError):
+            if attempt == retries:
+                raise
+        else:
+            break
+    return response, TransferStats(size, time.perf_counter() - start)
+
+@profiling.timed('saves.download_save')
+def download_save(game, bar=False, chunk_size=download_chunk_size,
+                  retries=download_retries):
+    """
+    Downloads a game savefile from the server and saves it into the
+    civilization 5 save directory from config. The save is written in large
+    chunks to a partial file in that directory, which is renamed into place
+    once complete. An interrupted download is resumed up to retries times,
+    and its partial file is kept for later calls if it still fails. A save
+    already prefetched for the current move is moved into place instead, in
+    which case the response is None. Returns the path of the file, the
+    response and TransferStats of the last attempt.
+    """
+    path = get_config_save_path()+game.name+" "+str(game.turn)+".Civ5Save"
+    prefetched = prefetch_name(game)
+    if os.path.exists(prefetched):
+        os.replace(prefetched, path)
+        response, stats = None, TransferStats(os.path.getsize(path), 0)
+    else:
+        response, stats = fetch_save_with_retries(
+            game, path, bar=bar, chunk_size=chunk_size, retries=retries)
+    if delta_transfer:
+        store_delta_base(game, path)
+    return path, response, stats
+
+def prefetch_name(game):
+    """
+    Returns the path in the prefetch directory of the save of a game's
+    current move.
+    """
+    return os.path.join(get_config_save_path(), prefetch_dir_name,
+                        "{} {} {}.Civ5Save".format(
+                            game.id, game.turn,
+                            game.json['currentlyMovingPlayer']))
+
+def clean_prefetches(game):
+    """
+    Removes prefetched saves and partial prefetches of a game's earlier
+    moves.
+    """
+    current = prefetch_name(game)
+    pattern = os.path.join(glob.escape(os.path.dirname(current)),
+                           glob.escape(game.id)+" *")
+    for name in glob.glob(pattern):
+        if not name.startswith(current):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+def prefetch_save(game, retries=download_retries):
+    """
+    Starts downloading the save of a game's current move into the prefetch
+    directory in a background thread, from where download_save moves it into
+    place. Prefetches of earlier moves are removed first. A failed prefetch
+    is dropped, keeping its partial file to be resumed by the next one.
+    Returns the thread.
+    """
+    def run():
+        path = prefetch_name(game)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        clean_prefetches(game)
+        if os.path.exists(path):
+            return
+        try:
+            fetch_save_with_retries(game, path, retries=retries)
+        except (ServerError, OSError, IncompleteDownloadError,
+                delta.DeltaMismatchError):
+            pass
+    thread = threading.Thread(target=run, name="prefetch "+game.id,
+                              daemon=True)
+    thread.start()
+    return thread
 
 # Unfinished
 def check_kills(game, file_name=None):
@@ -91,6 +374,7 @@ def check_kills(game, file_name=None):
     if file_name is None:
         file_name = select_upload_file(game)
 
+@profiling.timed('saves.validate_upload_file')
 def validate_upload_file(game, file_name=None):
     """
     Checks if a savefile is valid for upload to a specific game end point, 
@@ -98,7 +382,7 @@ def validate_upload_file(game, file_name=None):
     """
     if file_name is None:
         file_name = select_upload_file(game)
-    save = save_parser.parse_file(file_name)
+    save = read_save(file_name, ('turn', 'current', 'first_player'))
 
     turn_server = game.turn
     current_server = game.currently_moving_player_number()
@@ -116,45 +400,82 @@ def validate_upload_file(game, file_name=None):
 
     return True
 
-def select_upload_file(game):
-    """Chooses the file to upload and returns its path."""
-    path = get_config_save_path()
-    desired_name_bulk = path+game.name
+def expected_upload_file(game):
+    """Returns the path under which the save to upload is expected."""
+    desired_name_bulk = get_config_save_path()+game.name
     if game.json['gameState'] == 'WAITING_FOR_FIRST_MOVE':
-        desired_name = desired_name_bulk + ".Civ5Save"
+        return desired_name_bulk + ".Civ5Save"
     else:
-        desired_name = desired_name_bulk + " " + str(game.turn) + ".Civ5Save"
+        return desired_name_bulk + " " + str(game.turn) + ".Civ5Save"
+
+@profiling.timed('saves.select_upload_file')
+def select_upload_file(game):
+    """Chooses the file to upload and returns its path."""
+    desired_name = expected_upload_file(game)
     l = glob.glob(desired_name)
     if not l:
         raise MissingSaveFileError(desired_name)
     return l[0]
 
+@profiling.timed('saves.confirm_password')
 def confirm_password(game, file_name=None):
     """Checks if the user set his password."""
     if file_name is None:
         file_name = select_upload_file(game)
-    password_list = save_parser.parse_file(file_name)['password_list']
+    password_list = read_save(file_name, ('password_list',))['password_list']
     if password_list[game.find_own_player_number()-1]:
         return True
     return False
 
+@profiling.timed('saves.upload_delta')
+def upload_delta(game, file_):
+    """
+    Uploads a save as a delta from the last save exchanged in the game.
+    Returns the response, or None if there is no base, the delta isn't
+    smaller than the save or the server doesn't accept it.
+    """
+    base = read_delta_base(game)
+    if base is None:
+        return None
+    save = file_.read()
+    data = delta.encode(base, save)
+    if len(data) >= len(save):
+        return None
+    response = game.interface.post_request(
+        "/games/"+game.id+"/finish-turn-delta",
+        files={'file':io.BytesIO(data)},
+        headers={'X-Delta-Base':delta.checksum(base)},
+        statuses=(200, 404, 405, 409, 412, 415))
+    if response.status_code != 200:
+        return None
+    return response
+
+@profiling.timed('saves.upload_save')
 def upload_save(game, file_name=None, bar=False):
     """
     Uploads a savefile from the civilization 5 save directory corresponding to
     the game (i.e. starting with the name of the game) and removes the file.
+    With delta_transfer only the delta from the last save exchanged in the
+    game is sent if the server accepts it.
     Returns the name of the removed file.
     """
     if file_name is None:
         file_name = select_upload_file(game)
-    file_ = open(file_name, 'rb')
     with open(file_name, 'rb') as file_:
-        files = {'file':file_}
-        response = game.interface.post_request(
-            "/games/"+game.id+"/finish-turn", files=files, bar=bar)
-    config = ConfigParser()
-    config.read(config_file_name)
-    if (config.has_section('Saves')
-            and config.has_option('Saves', 'delete_saves')):
-        if config['Saves']['delete_saves'].lower() == 'true':
-            os.remove(file_name)
+        response = upload_delta(game, file_) if delta_transfer else None
+        if response is None:
+            file_.seek(0)
+            files = {'file':file_}
+            response = game.interface.post_request(
+                "/games/"+game.id+"/finish-turn", files=files, bar=bar,
+                compress=True)
+    if delta_transfer:
+        store_delta_base(game, file_name)
+    if config.getboolean('Saves', 'delete_saves', fallback=False):
+        os.remove(file_name)
     return file_name, response
+
+async def upload_save_async(game, async_interface, file_name=None, bar=False):
+    """Coroutine version of upload_save run by an AsyncInterface."""
+    return await async_interface.run_in_executor(
+        upload_save, game, file_name=file_name, bar=bar)
@@ -0,0 +1,157 @@
+"""
+This module contains watching the save directory, so that a turn can be
+uploaded as soon as its save is written.
+"""
+
+from sys import platform
+import os
+import select
+import struct
+import time
+
+from civ5client import config, saves
+
+# Seconds a save must stay unchanged before it's considered complete
+settle_time = config.getfloat('Saves', 'watch_settle_time', fallback=2.0)
+# Seconds between checks when inotify is unavailable
+poll_interval = config.getfloat('Saves', 'watch_poll_interval', fallback=2.0)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII') # watch descriptor, mask, cookie, name length
+
+class PollingWatcher():
+    """Waits for changes in a directory by sleeping between checks."""
+
+    def __init__(self, directory, interval=poll_interval):
+        self.directory = directory
+        self.interval = interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def wait(self, timeout=None):
+        """Sleeps until the next check."""
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+        return None
+
+    def close(self):
+        pass
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Waits for files in a directory to be written or moved into it, using
+    Linux inotify, so no time is spent while nothing happens.
+    """
+
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+        self.directory = directory
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watch = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout=None):
+        """
+        Blocks until files are written or timeout seconds pass. Returns the
+        names of the written files.
+        """
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        position = 0
+        while position < len(data):
+            _, _, _, length = EVENT.unpack_from(data, position)
+            position += EVENT.size
+            names.append(os.fsdecode(
+                data[position:position+length].rstrip(b'\0')))
+            position += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+def new_watcher(directory):
+    """Returns an InotifyWatcher if possible, a PollingWatcher otherwise."""
+    if platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory)
+
+def file_state(path):
+    """Returns the size and mtime of a file, or None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def turn_save_problem(game, path, force=False):
+    """
+    Returns why a save can't be uploaded as the turn: no password set, the
+    turn not made or the save not complete. Returns None if it can be, and
+    always if force is set.
+    """
+    if force:
+        return None
+    try:
+        if not saves.confirm_password(game, path):
+            return "Password not set"
+        if (game.is_validation_enabled()
+                and not saves.validate_upload_file(game, path)):
+            return "Turn not taken/invalid turn"
+    except (OSError, ValueError, IndexError, struct.error):
+        # the game may replace the file while it's read
+        return "Not a complete save"
+    return None
+
+def wait_for_turn_save(game, force=False, settle=settle_time, on_reject=None):
+    """
+    Blocks until the save expected for upload is completely written and
+    valid, and returns its path. A save stays under observation until it
+    has been unchanged for settle seconds. Saves already present that
+    aren't valid, or any saves present with server validation disabled or
+    force set, are waited on until they're written again. A save that can't
+    be uploaded is passed to on_reject, if given, with the reason.
+    """
+    path = saves.expected_upload_file(game)
+    checked = None
+    if force or not game.is_validation_enabled():
+        checked = file_state(path)
+    state = file_state(path)
+    changed_at = time.monotonic()
+    with new_watcher(os.path.dirname(path)) as watcher:
+        while True:
+            new_state = file_state(path)
+            if new_state != state:
+                state = new_state
+                changed_at = time.monotonic()
+            elapsed = time.monotonic() - changed_at
+            if state is not None and state != checked and elapsed >= settle:
+                checked = state
+                problem = turn_save_problem(game, path, force)
+                if problem is None:
+                    return path
+                if on_reject is not None:
+                    on_reject(path, problem)
+            if state is not None and state != checked:
+                watcher.wait(max(settle - elapsed, 0))
+            else:
+                watcher.wait()
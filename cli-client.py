@@ -6,21 +6,34 @@ Script to make full use of the civ5client package to play Civilization 5 in
 a play-by-email fashion in connection with a dedicated civ5-pbem-server.
 
 Usage:
-    cli-client.py init 
-    cli-client.py new-game <game-name> <game-description> <map-size> 
-    cli-client.py (list | list-civs) 
-    cli-client.py info <game> [--verbose]
+    cli-client.py init [--profile] [--profile-json=<file>]
+    cli-client.py new-game <game-name> <game-description> <map-size>
+                  [--profile] [--profile-json=<file>]
+    cli-client.py (list | list-civs | poll) [--profile] [--profile-json=<file>]
+    cli-client.py info (<game> | --all) [--verbose]
+                  [--profile] [--profile-json=<file>]
     cli-client.py (join | leave | start | disable-validation) <game>
-    cli-client.py (download | upload) <game> [--force] 
-    cli-client.py kick <game> <player> 
-    cli-client.py choose-civ <game> <player> <civilization> 
-    cli-client.py choose-civ <game> <civilization> 
-    cli-client.py change-player-type <game> <player> <player-type> 
+                  [--profile] [--profile-json=<file>]
+    cli-client.py (download | upload) (<game> | --all) [--force] [--jobs=<n>]
+                  [--profile] [--profile-json=<file>]
+    cli-client.py watch <game> [--force] [--profile] [--profile-json=<file>]
+    cli-client.py kick <game> <player> [--profile] [--profile-json=<file>]
+    cli-client.py choose-civ <game> <player> <civilization>
+                  [--profile] [--profile-json=<file>]
+    cli-client.py choose-civ <game> <civilization>
+                  [--profile] [--profile-json=<file>]
+    cli-client.py change-player-type <game> <player> <player-type>
+                  [--profile] [--profile-json=<file>]
     cli-client.py reset-access-token <email>
+                  [--profile] [--profile-json=<file>]
+    cli-client.py analyze <dir> [--workers=<n>]
+                  [--profile] [--profile-json=<file>]
     cli-client.py (-h | --help)
     cli-client.py --version
 
-    <game> can be either a game id or reference number (first given by list)
+    <game> can be either a game id or reference number (first given by list).
+    For info, download and upload it can also be a glob pattern over game
+    names, e.g. "league*", to act on all matching games.
     <player> can be either a player id or the player number in a game
 
 Commands:
@@ -29,6 +42,13 @@ Commands:
     --force                 Forces an attempt to perform an action without
                             clientside validation
     --verbose, -v           Prints more information
+    --workers=<n>           Number of processes to use [default: all cores]
+    --all                   Acts on all games
+    --jobs=<n>              Number of games handled at once (batch_workers
+                            in config.ini by default)
+    --profile               Prints where the time went, per phase and
+                            request, at exit
+    --profile-json=<file>   Writes that as JSON to a file
 
     init                    Checks configuration and completes it if incomplete. 
                             It is ran whenever any other command is used regardless.
@@ -38,6 +58,8 @@ Commands:
 
     list                    Prints a list of existing games
     list-civs               Prints a list of allowed civs
+    poll                    Keeps checking the games and notifies when it's your
+                            turn (see notify_command in config.ini)
         
     info                    Prints information about a game
 
@@ -48,6 +70,8 @@ Commands:
 
     download                Downloads a save (when it's your turn to move)
     upload                  Uploads and removes a save, performs the next turn
+    watch                   Waits until the save for upload is written and
+                            valid, then uploads it like upload
 
     choose-civ              Changes your own civilization. If <player> is
                             provided and you're the host, it allows you 
@@ -64,6 +88,10 @@ Commands:
     reset-access-token      Sends a request to reset the access token and
                             to have a new one sent to the email address.
 
+    analyze                 Parses all saves in a directory and prints their
+                            data as JSON lines. Saves unchanged since the
+                            last run are not parsed again.
+
 Map sizes:
     duel      max 2 players and 4 city states
     tiny      max 4 players and 8 city states
@@ -72,21 +100,27 @@ Map sizes:
     large     max 10 players and 20 city states
     huge      max 12 players and 24 city states
 """
+from docopt import docopt
+
+# Arguments are parsed before anything else is imported, so that --help and
+# --version return at once
+opts = docopt(__doc__, help=True, version=("civ5client command line interface "
+                                           "v0.2.0"))
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+import glob
+import os
 import sys
 import time
-import traceback
-
-from docopt import docopt
-from configparser import ConfigParser
-import requests
 
 import civ5client
-from civ5client import account, saves, games, InvalidConfigurationError, ServerError, config_file_name
+from civ5client import account, saves, games, save_parser, watch, poll, batch, profiling, config, InvalidConfigurationError, ServerError
 from civ5client.games import InvalidReferenceNumberError, WrongMoveError, InvalidIdError
 from civ5client.saves import MissingSaveFileError
 
-opts = docopt(__doc__, help=True, version=("civ5client command line interface "
-                                           "v0.2.0"))
+if opts['--profile'] or opts['--profile-json']:
+    profiling.enable()
 
 def yes_no_question(question):
     answer = input(question+" [y/n]: ")
@@ -95,7 +129,7 @@ def yes_no_question(question):
     else:
         return False
 
-def pretty_print_game(game_json, civ_json, short=False):
+def pretty_print_game(game_json, civ_catalog, short=False):
     if not short:
         print("ID:", game_json['id'],
               "\nName:", game_json['name'],
@@ -109,8 +143,7 @@ def pretty_print_game(game_json, civ_json, short=False):
               "\nSave file validation:", game_json['isSaveGameValidationEnabled'],
               "\nPlayers:")
         for player in game_json['players']:
-            civ = next(civ for civ in civ_json
-                              if civ['code'] == player['civilization'])
+            civ = civ_catalog[player['civilization']]
             civ_string = civ['code']+" - "+civ['leader']+" - "+civ['name']
             print("\tID:", player['id'],
                   "\n\t\tUser:", player['humanUserAccount'],
@@ -125,34 +158,176 @@ def pretty_print_game(game_json, civ_json, short=False):
               "\nTurn number:", game_json['turnNumber'],
               "\nCurrent player:", game_json['currentlyMovingPlayer'])
 
+def fetch_startup_data(interface, game_list=False, civilizations=False):
+    """
+    Requests credentials and, when needed, the game list and civilization
+    catalog concurrently. Returns them in that order, with None for what was not
+    needed and an exception instance for a failed request.
+    """
+    calls = [interface.get_credentials,
+             (lambda: games.list_games(interface)[0]) if game_list else None,
+             ((lambda: games.civilization_catalog(interface)) if civilizations
+              else None)]
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(call) if call is not None else None
+                   for call in calls]
+    return [future and (future.exception() or future.result())
+            for future in futures]
+
+def analyze(directory, workers=None):
+    """
+    Parses all saves in a directory in worker processes and prints their
+    data as JSON lines.
+    """
+    import multiprocessing
+    file_names = sorted(glob.glob(
+        os.path.join(glob.escape(directory), "*.Civ5Save")))
+    # Worker processes must not rerun this script, so without fork
+    # saves are parsed in this process
+    context = None
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        workers = 0
+    results = save_parser.parse_files(
+        file_names, metadata=saves.get_save_metadata(directory),
+        workers=workers, mp_context=context)
+    for file_name, metadata, error in results:
+        line = {'file':file_name}
+        line.update(metadata if error is None else {'error':error})
+        print(dumps(line))
+
+def download_game(game, force=False):
+    """Downloads the save of a game in a batch and returns a summary."""
+    file_name, response, stats = game.download(force=force)
+    return "{} ({:.2f} MB in {:.2f} s)".format(file_name, stats.size / 10**6,
+                                               stats.seconds)
+
+def upload_game(game, force=False):
+    """
+    Checks and uploads the save of a game in a batch, failing instead of
+    asking when the check fails. Returns a summary.
+    """
+    if not game.to_move():
+        raise WrongMoveError
+    file_name = saves.select_upload_file(game)
+    if not force:
+        if not saves.confirm_password(game, file_name):
+            raise ValueError("Password not set. Set it or use --force")
+        if (game.is_validation_enabled()
+                and not saves.validate_upload_file(game, file_name)):
+            raise ValueError("Turn not taken/invalid turn. If it's a client "
+                             "error, try --force")
+    return game.upload(file_name)[0]
+
+def describe_error(error):
+    """Returns a message for an exception raised for a game."""
+    if isinstance(error, MissingSaveFileError):
+        return "Save file "+error.args[0]+" not found"
+    if isinstance(error, ServerError):
+        return "Server error: "+str(error.args[0])
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "Failed to connect to server"
+    if isinstance(error, saves.IncompleteDownloadError):
+        return "Download interrupted. Run download again to resume it"
+    if isinstance(error, ValueError):
+        return str(error)
+    return "{}: {}".format(type(error).__name__, error)
+
+def print_batch_summary(results, log_name):
+    """
+    Prints the outcome for each game of a batch and the totals. Tracebacks
+    of failures are appended to the log.
+    """
+    failed = skipped = 0
+    for result in results:
+        if result.ok:
+            print("OK      ", result.game.name+":", result.value)
+        elif isinstance(result.error, WrongMoveError):
+            skipped += 1
+            print("SKIPPED ", result.game.name+": Not your move")
+        else:
+            failed += 1
+            print("FAILED  ", result.game.name+":",
+                  describe_error(result.error))
+            civ5client.log_error(result.error, log_name)
+    print("{} done, {} skipped, {} failed".format(
+        len(results) - failed - skipped, skipped, failed))
+
+def write_profile():
+    """
+    Prints the profile to stderr with --profile, and writes it as JSON with
+    --profile-json.
+    """
+    data = profiling.report()
+    if opts['--profile']:
+        print(profiling.format_report(data), file=sys.stderr)
+    if opts['--profile-json']:
+        with open(opts['--profile-json'], 'w') as profile_file:
+            profile_file.write(dumps(data, indent=2) + '\n')
+
+def report_poll_error(error):
+    """Prints and logs a failed poll, after which polling goes on."""
+    print(time.strftime("%Y-%m-%d %H:%M:%S"), "Error:", describe_error(error)
+          + "; retrying later")
+    civ5client.log_error(error, log_name)
+
+def report_notify_error(error):
+    """Prints and logs a failed notification, after which polling goes on."""
+    print(time.strftime("%Y-%m-%d %H:%M:%S"), "Error: Failed to notify:",
+          describe_error(error))
+    civ5client.log_error(error, log_name)
+
+def report_rejected_save(file_name, problem):
+    """Prints why a watched save isn't uploaded, after which watching goes on."""
+    print("Not uploading", file_name+":", problem+". Waiting for it to be",
+          "saved again; use --force to upload it regardless")
+
+def raise_failed(result):
+    """Raises a result of fetch_startup_data if it's an exception."""
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+#
+# Save analysis, which needs no server
+#
+if opts['analyze']:
+    try:
+        workers = None
+        if opts['--workers'] != 'all cores':
+            workers = int(opts['--workers'])
+        analyze(opts['<dir>'], workers=workers)
+    finally:
+        if profiling.enabled:
+            write_profile()
+    exit()
+
+import requests
+
+session = civ5client.new_session()
 try:
-    config = ConfigParser()
-    config.read(config_file_name)
     #
     # Initial config
     #
-    if not config.has_section('Client Settings'):
-        config.add_section('Client Settings')
     if (not config.has_option('Client Settings', 'log_name')
             or not config.has_option('Client Settings', 'log_responses')):
         if not opts['init'] and not opts['reset-access-token']:
             print("Missing or incomplete config; attempting to fix")
-        config['Client Settings']['log_name'] = "log.txt"
-        config['Client Settings']['log_responses'] = "False"
-        config.write(open(config_file_name, 'w'))
-    log_name = config['Client Settings']['log_name']
+        config.set_options('Client Settings', {'log_name':"log.txt",
+                                               'log_responses':"False"})
+    log_name = config.get('Client Settings', 'log_name')
     #
     # Token reset
     #
     if opts['reset-access-token']:
-        try:
-            address = config['Interface Settings']['server_address']
-        except KeyError:
+        address = config.get('Interface Settings', 'server_address')
+        if address is None:
             address = input("Write the server address: ")
             address = civ5client.parse_address(address)
         email = opts['<email>']
         print("Sending a reset request")
-        response = account.reset_access_token(address, email)
+        response = account.reset_access_token(address, email, session=session)
         if response.status_code == 200:
             print("Reset request successful. Please check your email")
         if response.status_code != 200:
@@ -167,7 +342,7 @@ try:
     # Registration and credentials
     #
     try:
-        interface = civ5client.Interface.from_config()
+        interface = civ5client.Interface.from_config(session=session)
     except InvalidConfigurationError:
         address = input("Write the server address: ")
         address = civ5client.parse_address(address)
@@ -178,7 +353,8 @@ try:
             email = input("Please write you email: ")
             print("Registering account")
             try:
-                account.register_account(address, username, email)
+                account.register_account(address, username, email,
+                                         session=session)
             except account.AccountTakenError:
                 # TODO: Should be a loop asking for different emails
                 print("Error: Account already taken")
@@ -186,12 +362,18 @@ try:
             else:
                 print("An email with the access token has been sent")
         access_token = input("Write the access token from the email: ")
-        interface = civ5client.Interface(address, access_token)
+        interface = civ5client.Interface(address, access_token,
+                                         session=session)
         print("Saving interface credentials to config")
         interface.save_config()
+    with profiling.span("fetch_startup_data"):
+        credentials, game_list, civ_catalog = fetch_startup_data(
+            interface,
+            game_list=opts['<game>'] is not None or opts['--all'],
+            civilizations=(opts['info'] or opts['join']
+                           or opts['list-civs'] or opts['choose-civ']))
     try:
-        response = account.request_credentials(interface)
-        json = response.json()
+        json = raise_failed(credentials)
         if opts['init']:
             print("Logged in as", json['username'],
                   "with email", json['email'])
@@ -221,8 +403,7 @@ try:
         saves.save_save_path_config(path)
     # If no delete_saves option found, create it and make it True
     if not config.has_option('Saves', 'delete_saves'):
-        config['Saves']['delete_saves'] = 'True'
-        config.write(open(config_file_name, 'w'))
+        config.set_options('Saves', {'delete_saves':'True'})
     #
     # Commands
     #
@@ -251,34 +432,69 @@ try:
                 string += " <- Your move"
             print(string)
 
+    if opts['poll']:
+        print("Waiting for your turn. Press Ctrl+C to stop")
+        try:
+            for turns in poll.poll_turns(interface,
+                                         on_error=report_poll_error):
+                for game in turns:
+                    print(time.strftime("%Y-%m-%d %H:%M:%S"),
+                          "Your move in", game.name, "turn", game.turn)
+                    poll.notify(game, on_error=report_notify_error)
+                    if saves.prefetch_saves:
+                        game.prefetch()
+        except KeyboardInterrupt:
+            pass
+
     if opts['list-civs']:
-        response = games.get_civilizations(interface)
-        json = response.json()
         base_string = "{:8}\t{:8}\t{:8}"
         print(base_string.format("Code", "Name", "Leader"))
-        for civ in json:
+        for civ in raise_failed(civ_catalog).values():
             print(base_string.format(civ['code'],
                                      civ['name'],
                                      civ['leader']))
 
 
-    if opts['<game>']:
-        game = games.Game.from_any(interface, opts['<game>'])
+    many_games = ((opts['info'] or opts['download'] or opts['upload'])
+                  and (opts['--all'] or batch.is_pattern(opts['<game>'])))
+    if many_games:
+        game_batch = batch.select_games(
+            interface, games.GameIndex(raise_failed(game_list)),
+            opts['<game>'])
+        if not game_batch:
+            print("No games match", opts['<game>'])
+        workers = batch.batch_workers
+        if opts['--jobs'] is not None:
+            workers = int(opts['--jobs'])
+
+    if many_games and opts['info']:
+        civs = raise_failed(civ_catalog)
+        for game in game_batch:
+            pretty_print_game(game.json, civs, short=not opts['--verbose'])
+            print()
+
+    if many_games and (opts['download'] or opts['upload']):
+        action = download_game if opts['download'] else upload_game
+        results = batch.run_batch(
+            lambda game: action(game, force=opts['--force']), game_batch,
+            workers=workers, bar=True)
+        print_batch_summary(results, log_name)
+
+    if opts['<game>'] and not many_games:
+        game = games.Game.from_any(
+            interface, opts['<game>'], games.GameIndex(raise_failed(game_list)))
         if opts['<player>']:
             player = games.Player.from_any(game, opts['<player>'])
 
-    if opts['info']:
-        response = games.get_civilizations(interface)
-        json = response.json()
+    if opts['info'] and not many_games:
         short = not opts['--verbose']
-        pretty_print_game(game.json, json, short=short)
+        pretty_print_game(game.json, raise_failed(civ_catalog), short=short)
 
     if opts['join']:
         try:
             response = game.join()
-            civ_json = games.get_civilizations(interface).json()
             json = response.json()
-            pretty_print_game(json, civ_json)
+            pretty_print_game(json, raise_failed(civ_catalog))
         except ServerError:
             print("Error: Failed to join game. Presumably you are already in it")
             raise
@@ -311,10 +527,17 @@ try:
         except ValueError:
             print("Error: Wrong civilization. list-civs to list acceptable civs")
 
-    if opts['download']:
+    if opts['download'] and not many_games:
         try:
-            file_name, response = game.download(force=opts['--force'], bar=True)
-            print("Downloaded",file_name)
+            file_name, response, stats = game.download(
+                force=opts['--force'], bar=True)
+            if response is None:
+                print("Moved prefetched save into place:", file_name)
+            else:
+                print("Downloaded",file_name)
+                print("{:.2f} MB in {:.2f} s ({:.2f} MB/s)".format(
+                    stats.size / 10**6, stats.seconds,
+                    stats.throughput / 10**6))
             print(("Please complete your turn by loading it in hotseat mode, "
                    "performing a turn, saving it in the menu so that the next "
                    "player can continue and uploading it to the server."))
@@ -323,23 +546,27 @@ try:
             raise
         except WrongMoveError:
             print("Error: Not your move to download")
+        except saves.IncompleteDownloadError:
+            print("Error: Download interrupted. Run download again to resume it")
 
-    if opts['upload']:
+    if opts['upload'] and not many_games:
         try:
-            if not opts['--force'] and not saves.confirm_password(game):
+            file_name = saves.select_upload_file(game)
+            if (not opts['--force']
+                    and not saves.confirm_password(game, file_name)):
                 print("Warning: Password not set. You should download the save again and set it")
                 if not yes_no_question(
                         ("Are you sure you want to continue and upload it "
                     "regardless?")):
                     exit()
             if game.is_validation_enabled() and not opts['--force']:
-                valid = saves.validate_upload_file(game)
+                valid = saves.validate_upload_file(game, file_name)
                 if not valid:
                     print(("Error: Turn not taken/invalid turn. If it's a "
                            "client error, try --force"))
                 print("Save valid. Proceeding to upload")
-            file_name, response = game.upload(bar=True)
-            if config['Saves']['delete_saves'].lower() == 'true':
+            file_name, response = game.upload(file_name, bar=True)
+            if config.getboolean('Saves', 'delete_saves'):
                 print("Uploaded and removed", file_name, "without errors")
             else:
                 print("Uploaded", file_name, "without errors")
@@ -350,9 +577,25 @@ try:
         except WrongMoveError:
             print("Error: Not your move to upload")
 
+    if opts['watch']:
+        try:
+            if not game.to_move():
+                raise WrongMoveError
+            print("Waiting for", saves.expected_upload_file(game),
+                  "to be saved with the turn done")
+            file_name = watch.wait_for_turn_save(
+                game, force=opts['--force'], on_reject=report_rejected_save)
+            file_name, response = game.upload(file_name, bar=True)
+            if config.getboolean('Saves', 'delete_saves'):
+                print("Uploaded and removed", file_name, "without errors")
+            else:
+                print("Uploaded", file_name, "without errors")
+        except WrongMoveError:
+            print("Error: Not your move to upload")
+
 except requests.exceptions.ConnectionError:
     print("Error: Failed to connect to server")
-    traceback.print_exc(file=open(log_name,'a'))
+    civ5client.log_error(sys.exc_info()[1], log_name)
 except InvalidReferenceNumberError:
     print("Error: No game or player with such reference number")
 except InvalidIdError:
@@ -361,7 +604,11 @@ except ServerError as e:
     print("Server error:", e.args[0])
     print("For contents of the response, please enable response logging in the"
           " config and try again.")
-    traceback.print_exc(file=open(log_name,'a'))
+    civ5client.log_error(sys.exc_info()[1], log_name)
 except:
-    traceback.print_exc(file=open(log_name,'a'))
+    civ5client.log_error(sys.exc_info()[1], log_name)
     raise
+finally:
+    session.close()
+    if profiling.enabled:
+        write_profile()
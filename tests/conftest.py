@@ -0,0 +1,84 @@
+"""
+Fixtures running civ5client against benchmarks/fake_server.py, so that the
+tests need no network. civ5client reads config.ini from the working
+directory once, on import, so the tests run in a temporary directory whose
+config is written before anything imports it.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.join(repo_dir, 'benchmarks'))
+
+config_template = """[Client Settings]
+log_name = log.txt
+log_responses = False
+games_cache_ttl = 0
+credentials_cache_ttl = 0
+
+[Saves]
+save_path = {save_path}
+delete_saves = False
+metadata_index = False
+"""
+
+work_dir = tempfile.mkdtemp(prefix='civ5client-tests-')
+save_path = os.path.join(work_dir, 'saves') + os.sep
+with open(os.path.join(work_dir, 'config.ini'), 'w') as config_file:
+    config_file.write(config_template.format(save_path=save_path))
+os.chdir(work_dir)
+
+import civ5client
+from civ5client import saves
+import fake_server
+
+def pytest_unconfigure(config):
+    os.chdir(repo_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+@pytest.fixture(autouse=True)
+def clean_work_dir():
+    """Empties the save directory and caches left by an earlier test."""
+    for name in os.listdir(work_dir):
+        path = os.path.join(work_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif name != 'config.ini':
+            os.remove(path)
+    os.mkdir(save_path)
+    saves.metadata_caches.clear()
+
+@pytest.fixture
+def server():
+    """
+    A fake server with an account whose access token is test, to move in
+    two games with small saves.
+    """
+    server = fake_server.FakeServer(('127.0.0.1', 0), seed=1)
+    server.populate('test', 'test', games=2, players=4, size=200*1000)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def interface(server):
+    with civ5client.Interface(server.address, 'test') as interface:
+        yield interface
+
+@pytest.fixture
+def save_requests(monkeypatch):
+    """Headers of the save downloads the fake server gets, in order."""
+    headers = []
+    save_game = fake_server.Handler.save_game
+    def recording_save_game(self, body, game_id):
+        headers.append(dict(self.headers))
+        save_game(self, body, game_id)
+    monkeypatch.setattr(fake_server.Handler, 'save_game', recording_save_game)
+    return headers
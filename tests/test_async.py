@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+import civ5client
+from civ5client import games, saves
+import fake_server
+
+def test_gather_requests(server, interface, tmp_path, monkeypatch):
+    spans = []
+    dispatch = fake_server.Handler.dispatch
+    def timed_dispatch(self, method):
+        start = time.monotonic()
+        dispatch(self, method)
+        spans.append((self.path, start, time.monotonic()))
+    monkeypatch.setattr(fake_server.Handler, 'dispatch', timed_dispatch)
+    server.faults = fake_server.Faults(latency=0.5)
+    first_game = games.Game(interface, server.games[0])
+    second_game = games.Game(interface, server.games[1])
+    file_name = str(tmp_path / 'turn.Civ5Save')
+    with open(file_name, 'wb') as file_:
+        file_.write(b'turn done' * 1000)
+
+    async def gather(async_interface):
+        return await asyncio.gather(
+            games.list_games_async(async_interface),
+            first_game.download_async(async_interface),
+            saves.upload_save_async(second_game, async_interface, file_name))
+
+    with civ5client.AsyncInterface(interface) as async_interface:
+        game_list, download, upload = async_interface.run(
+            gather(async_interface))
+
+    assert [game['id'] for game in game_list[0]] == ['game1', 'game2']
+    with open(download[0], 'rb') as file_:
+        assert file_.read() == server.saves['game1']
+    assert upload[0] == file_name
+    assert server.saves['game2'] == b'turn done' * 1000
+    # Four requests of 0.5 s, at most two of which depend on each other
+    # The game list, the account needed by the download and the upload are
+    # requested at once, so they overlap
+    first = [span for span in spans if 'save-game' not in span[0]]
+    assert sorted(path for path, start, end in first) == [
+        '/games/', '/games/game2/finish-turn', '/user-accounts/current']
+    assert max(start for path, start, end in first) \
+        < min(end for path, start, end in first)
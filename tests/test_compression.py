@@ -0,0 +1,77 @@
+import pytest
+
+from civ5client import games, saves, ServerError
+import fake_server
+
+@pytest.fixture
+def posts(monkeypatch):
+    """Paths and Content-Encoding of the posts the fake server gets."""
+    requests_ = []
+    do_post = fake_server.Handler.do_POST
+    def recording_do_post(self):
+        requests_.append((self.path, self.headers.get('Content-Encoding')))
+        do_post(self)
+    monkeypatch.setattr(fake_server.Handler, 'do_POST', recording_do_post)
+    return requests_
+
+@pytest.fixture
+def turn_file(tmp_path):
+    file_name = str(tmp_path / 'turn.Civ5Save')
+    with open(file_name, 'wb') as file_:
+        file_.write(b'turn done' * 1000)
+    return file_name
+
+def reject_compressed(monkeypatch, status):
+    """Makes the fake server answer compressed posts with status."""
+    finish_turn = fake_server.Handler.finish_turn
+    def rejecting_finish_turn(self, body, game_id):
+        if self.headers.get('Content-Encoding'):
+            raise fake_server.RequestError(status, "Can't read the body")
+        finish_turn(self, body, game_id)
+    monkeypatch.setattr(fake_server.Handler, 'finish_turn',
+                        rejecting_finish_turn)
+
+def test_compressed_upload(server, interface, posts, turn_file):
+    interface.upload_encoding = 'gzip'
+    game = games.Game(interface, server.games[0])
+    saves.upload_save(game, turn_file)
+    assert server.saves[game.id] == b'turn done' * 1000
+    assert [encoding for path, encoding in posts] == ['gzip']
+    assert interface.upload_encoding == 'gzip'
+
+@pytest.mark.parametrize('status', [411, 415])
+def test_upload_falls_back_to_uncompressed(server, interface, posts,
+                                           turn_file, monkeypatch, status):
+    reject_compressed(monkeypatch, status)
+    interface.upload_encoding = 'gzip'
+    game = games.Game(interface, server.games[0])
+    saves.upload_save(game, turn_file)
+    assert server.saves[game.id] == b'turn done' * 1000
+    assert [encoding for path, encoding in posts] == ['gzip', None]
+    assert interface.upload_encoding is None
+
+def test_rejected_upload_is_not_sent_again(server, interface, posts,
+                                           turn_file, monkeypatch):
+    def rejecting_finish_turn(self, body, game_id):
+        raise fake_server.RequestError(400, "Turn not taken")
+    monkeypatch.setattr(fake_server.Handler, 'finish_turn',
+                        rejecting_finish_turn)
+    interface.upload_encoding = 'gzip'
+    game = games.Game(interface, server.games[0])
+    with pytest.raises(ServerError):
+        saves.upload_save(game, turn_file)
+    assert [encoding for path, encoding in posts] == ['gzip']
+    assert interface.upload_encoding == 'gzip'
+
+def test_server_error_is_not_sent_again(
+        server, interface, posts, turn_file, monkeypatch):
+    def failing_finish_turn(self, body, game_id):
+        raise fake_server.RequestError(500, "Database down")
+    monkeypatch.setattr(fake_server.Handler, 'finish_turn',
+                        failing_finish_turn)
+    interface.upload_encoding = 'gzip'
+    game = games.Game(interface, server.games[0])
+    with pytest.raises(ServerError):
+        saves.upload_save(game, turn_file)
+    assert [encoding for path, encoding in posts] == ['gzip']
+    assert interface.upload_encoding == 'gzip'
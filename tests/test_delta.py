@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from civ5client import delta, games, saves
+import fake_server
+import savegen
+
+@pytest.fixture
+def delta_transfer(monkeypatch):
+    monkeypatch.setattr(saves, 'delta_transfer', True)
+
+def edited(save, seed=1, edits=5, size=5000):
+    """
+    Returns a save with a few runs of up to size bytes changed, inserted and
+    removed.
+    """
+    rnd = random.Random(seed)
+    save = bytearray(save)
+    for i in range(edits):
+        position = rnd.randrange(len(save) - size)
+        save[position:position+size] = b'x' * rnd.randrange(1, size)
+        position = rnd.randrange(len(save))
+        save[position:position] = b'y' * rnd.randrange(1, size)
+        position = rnd.randrange(len(save))
+        del save[position:position+rnd.randrange(1, size)]
+    return bytes(save)
+
+@pytest.mark.parametrize('target', [
+    lambda base: base,
+    lambda base: edited(base),
+    lambda base: b'prefix' + base[:1000] + base[5000:],
+    lambda base: savegen.generate_save(size=len(base), seed=2),
+    lambda base: b'',
+    lambda base: base[:100]])
+def test_round_trip(target):
+    base = savegen.generate_save(size=100*1000)
+    target = target(base)
+    assert delta.apply(base, delta.encode(base, target)) == target
+
+def test_small_edits_give_small_deltas():
+    base = savegen.generate_save(size=1000*1000)
+    target = edited(base)
+    assert len(delta.encode(base, target)) < len(target) // 10
+
+def test_apply_rejects_wrong_base():
+    base = savegen.generate_save(size=10*1000)
+    data = delta.encode(base, edited(base))
+    with pytest.raises(delta.DeltaMismatchError):
+        delta.apply(base[1:], data)
+
+def test_download_as_delta(server, interface, save_requests, delta_transfer):
+    game = games.Game(interface, server.games[0])
+    saves.download_save(game)
+    with server.lock:
+        server.finish_turn(server.games[0],
+                           edited(server.saves[game.id], edits=1, size=100))
+    new_save = server.saves[game.id]
+    game = games.Game(interface, server.games[0])
+    path, response, stats = saves.download_save(game)
+    assert 'X-Delta-Base' in save_requests[-1]
+    assert response.headers['Content-Type'] == delta.CONTENT_TYPE
+    assert stats.size < len(new_save) // 5
+    with open(path, 'rb') as file_:
+        assert file_.read() == new_save
+
+@pytest.fixture
+def delta_uploads(monkeypatch):
+    """Sizes of the delta uploads the fake server gets."""
+    sizes = []
+    finish_turn_delta = fake_server.Handler.finish_turn_delta
+    def recording_finish_turn_delta(self, body, game_id):
+        sizes.append(len(body))
+        finish_turn_delta(self, body, game_id)
+    monkeypatch.setattr(fake_server.Handler, 'finish_turn_delta',
+                        recording_finish_turn_delta)
+    return sizes
+
+def test_upload_as_delta(server, interface, delta_transfer, delta_uploads,
+                         tmp_path):
+    game = games.Game(interface, server.games[0])
+    path, response, stats = saves.download_save(game)
+    with open(path, 'rb') as file_:
+        new_save = edited(file_.read(), seed=2, edits=1, size=100)
+    file_name = str(tmp_path / 'turn.Civ5Save')
+    with open(file_name, 'wb') as file_:
+        file_.write(new_save)
+    saves.upload_save(game, file_name)
+    assert server.saves[game.id] == new_save
+    assert len(delta_uploads) == 1
+    assert delta_uploads[0] < len(new_save) // 5
+
+def test_unrelated_save_is_uploaded_whole(server, interface, delta_transfer,
+                                          delta_uploads, tmp_path):
+    game = games.Game(interface, server.games[0])
+    saves.download_save(game)
+    new_save = savegen.generate_save(size=200*1000, seed=3)
+    file_name = str(tmp_path / 'turn.Civ5Save')
+    with open(file_name, 'wb') as file_:
+        file_.write(new_save)
+    saves.upload_save(game, file_name)
+    assert server.saves[game.id] == new_save
+    assert delta_uploads == []
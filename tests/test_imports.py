@@ -0,0 +1,15 @@
+import run
+
+def test_import_civ5client_defers_slow_modules(tmp_path):
+    times = run.import_times(['-c', 'import civ5client'], cwd=str(tmp_path))
+    assert ('civ5client', 0) in [(name, depth) for name, depth, time_ in times]
+    assert run.slow_imports(times) == []
+
+def test_cli_version_imports_no_slow_modules(tmp_path):
+    times = run.import_times([run.cli_client, '--version'], cwd=str(tmp_path))
+    assert run.slow_imports(times) == []
+
+def test_slow_imports_are_found(tmp_path):
+    times = run.import_times(['-c', 'import civ5client, requests, tqdm'],
+                             cwd=str(tmp_path))
+    assert {'requests', 'tqdm'} <= set(run.slow_imports(times))
@@ -0,0 +1,15 @@
+import civ5client
+from civ5client import games
+
+def test_error_is_logged_after_buffered_responses(server, interface,
+                                                  tmp_path):
+    log_file = str(tmp_path / 'log.txt')
+    response = games.list_games(interface)[1]
+    civ5client.log_response(response, log_file)
+    try:
+        raise ValueError("Broken save")
+    except ValueError as e:
+        civ5client.log_error(e, log_file)
+    with open(log_file) as file_:
+        log = file_.read()
+    assert 0 <= log.index("status 200") < log.index("ValueError: Broken save")
@@ -0,0 +1,70 @@
+import pytest
+import requests
+
+from civ5client import games, poll, ServerError
+import fake_server
+
+def test_poll_turns_yields_changed_games(server, interface):
+    intervals = []
+    polls = poll.poll_turns(interface, min_interval=1, max_interval=8,
+                            sleep=intervals.append)
+    assert sorted(game.id for game in next(polls)) == ['game1', 'game2']
+    assert next(polls) == []
+    assert next(polls) == []
+    # The only human player moved, so it's their turn again
+    with server.lock:
+        server.finish_turn(server.games[0], b'next turn')
+    assert [game.id for game in next(polls)] == ['game1']
+    assert next(polls) == []
+    # Changes reset the interval, otherwise it doubles
+    assert intervals == [pytest.approx(interval, rel=0.2)
+                         for interval in (1, 2, 4, 1)]
+
+def test_poll_turns_backs_off_on_server_errors(server, interface):
+    server.faults = fake_server.Faults(error_rate=1)
+    errors = []
+    intervals = []
+    def sleep(interval):
+        intervals.append(interval)
+        if len(intervals) == 4:
+            server.faults = fake_server.Faults()
+    polls = poll.poll_turns(interface, min_interval=1, max_interval=8,
+                            sleep=sleep, on_error=errors.append)
+    assert sorted(game.id for game in next(polls)) == ['game1', 'game2']
+    assert len(errors) == 4
+    assert all(isinstance(error, ServerError) for error in errors)
+    assert intervals == [pytest.approx(interval, rel=0.2)
+                         for interval in (2, 4, 8, 8)]
+
+def test_poll_turns_survives_connection_errors(server, interface):
+    address = interface.server_address
+    interface.server_address = 'http://127.0.0.1:1'
+    errors = []
+    def sleep(interval):
+        if len(errors) == 2:
+            interface.server_address = address
+    polls = poll.poll_turns(interface, min_interval=1, max_interval=8,
+                            sleep=sleep, on_error=errors.append)
+    assert len(next(polls)) == 2
+    assert len(errors) == 2
+    assert all(isinstance(error, requests.exceptions.ConnectionError)
+               for error in errors)
+
+def test_notify_arguments_keep_game_values_whole(server, interface):
+    game = games.Game(interface, dict(server.games[0],
+                                      name='x$(touch pwned); rm -rf ~'))
+    assert poll.notify_arguments(game, 'notify-send "Turn {turn}" {name}') \
+        == ['notify-send', 'Turn 57', 'x$(touch pwned); rm -rf ~']
+
+@pytest.mark.parametrize('command, error', [
+    ('no-such-notify-command {name}', FileNotFoundError),
+    ('notify-send {x}', KeyError),
+    ('notify-send {}', IndexError),
+    ('notify-send "{name}', ValueError)])
+def test_failed_notify_is_reported(server, interface, monkeypatch, command,
+                                   error):
+    monkeypatch.setattr(poll, 'notify_command', command)
+    game = games.Game(interface, server.games[0])
+    errors = []
+    poll.notify(game, on_error=errors.append)
+    assert [type(e) for e in errors] == [error]
@@ -0,0 +1,50 @@
+import random
+import zlib
+
+import pytest
+
+from civ5client import save_parser
+import savegen
+
+def test_parse_file_reads_generated_save(tmp_path):
+    file_name = str(tmp_path / 'save.Civ5Save')
+    savegen.write_save(file_name, size=100*1000, players=2, ai_players=3,
+                       turn=12, current=1, passwords=(1,))
+    metadata = save_parser.parse_file(file_name)
+    assert metadata['turn'] == 12
+    assert metadata['current'] == 1
+    assert metadata['first_player'] == 0
+    assert metadata['last_player'] == 1
+    assert metadata['password_list'][:3] == [False, True, False]
+    assert not any(metadata['dead_players'])
+
+def test_find_compressed_skips_stray_zlib_headers(tmp_path):
+    file_name = str(tmp_path / 'save.Civ5Save')
+    data = savegen.generate_save(size=100*1000)
+    with open(file_name, 'wb') as file_:
+        file_.write(data)
+    with save_parser.SaveReader(file_name) as sr:
+        start = sr.find_compressed()
+    # Random bytes with many zlib headers put in front of the game data
+    junk = bytearray(random.Random(1).getrandbits(8*4000).to_bytes(4000,
+                                                                   'little'))
+    for position in range(0, len(junk), 40):
+        junk[position:position+2] = save_parser.ZLIB_HEADER
+    with open(file_name, 'wb') as file_:
+        file_.write(data[:start] + junk + data[start:])
+    with save_parser.SaveReader(file_name) as sr:
+        assert sr.find_compressed() == start + len(junk)
+    game_data = b''.join(save_parser.iter_compressed(file_name))
+    assert game_data == zlib.decompress(data[start:])
+
+@pytest.mark.parametrize('players, ai_players, current, passwords', [
+    (1, 3, 0, (0,)), (4, 0, 3, ()), (8, 14, 5, (1, 2, 7))])
+def test_same_output_as_bitstring_parser(tmp_path, players, ai_players,
+                                         current, passwords):
+    bitstring_parser = pytest.importorskip('bitstring_parser')
+    file_name = str(tmp_path / 'save.Civ5Save')
+    savegen.write_save(file_name, size=100*1000, players=players,
+                       ai_players=ai_players, current=current,
+                       passwords=passwords)
+    assert (save_parser.parse_file(file_name)
+            == bitstring_parser.parse_file(file_name))
@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+
+from civ5client import games, saves
+import fake_server
+
+def test_download_resumes_after_dropped_connections(server, interface,
+                                                    save_requests, tmp_path):
+    server.faults = fake_server.Faults(drop_rate=0.8)
+    game = games.Game(interface, server.games[0])
+    save = server.saves[game.id]
+    path = str(tmp_path / 'save.Civ5Save')
+    response, stats = saves.fetch_save_with_retries(game, path, retries=50)
+    with open(path, 'rb') as file_:
+        assert file_.read() == save
+    resumed = [headers for headers in save_requests if 'Range' in headers]
+    assert resumed
+    assert all(headers['If-Range'] == fake_server.etag(save)
+               for headers in resumed)
+    assert not os.path.exists(saves.partial_download_names(path)[0])
+
+def test_download_restarts_when_save_changed(server, interface,
+                                             save_requests, tmp_path):
+    game = games.Game(interface, server.games[0])
+    old_save = server.saves[game.id]
+    path = str(tmp_path / 'save.Civ5Save')
+    part_name, meta_name = saves.partial_download_names(path)
+    with open(part_name, 'wb') as part_file:
+        part_file.write(old_save[:1000])
+    with open(meta_name, 'w') as meta_file:
+        json.dump({'length':len(old_save), 'etag':fake_server.etag(old_save),
+                   'last_modified':None}, meta_file)
+    with server.lock:
+        server.finish_turn(server.games[0], b'new save' * 1000)
+    saves.fetch_save_with_retries(game, path, retries=0)
+    assert save_requests[0]['Range'] == 'bytes=1000-'
+    with open(path, 'rb') as file_:
+        assert file_.read() == b'new save' * 1000
+
+def test_download_moves_prefetched_save_into_place(server, interface):
+    game = games.Game(interface, server.games[0])
+    game.prefetch().join()
+    path, response, stats = saves.download_save(game)
+    assert response is None
+    assert stats.throughput == 0
+    with open(path, 'rb') as file_:
+        assert file_.read() == server.saves[game.id]
+
+@pytest.fixture
+def compressing_server(server):
+    server.compress = True
+    server.faults = fake_server.Faults(drop_rate=1)
+    return server
+
+@pytest.mark.parametrize('encoding', ['gzip', None])
+def test_dropped_download_is_never_placed(compressing_server, interface,
+                                          save_requests, encoding):
+    interface.download_encoding = encoding
+    game = games.Game(interface, compressing_server.games[0])
+    with pytest.raises(saves.IncompleteDownloadError):
+        saves.download_save(game, retries=2)
+    path = saves.get_config_save_path()+game.name+" "+str(game.turn)
+    assert not os.path.exists(path+".Civ5Save")
+    expected = 'gzip, deflate' if encoding else 'identity'
+    assert [headers['Accept-Encoding'] for headers in save_requests][0] \
+        == expected
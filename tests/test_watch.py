@@ -0,0 +1,29 @@
+import os
+
+from civ5client import games, saves, watch
+import savegen
+
+def write_turn_save(path, **kwargs):
+    """Writes a save of the game's next turn, renamed into place at once."""
+    savegen.write_save(path+'.tmp', size=1000, players=1, ai_players=3,
+                       turn=58, current=0, **kwargs)
+    os.replace(path+'.tmp', path)
+
+def test_rejected_save_is_reported_until_saved_again(server, interface):
+    game = games.Game(interface, server.games[0])
+    path = saves.expected_upload_file(game)
+    write_turn_save(path, passwords=())
+    rejected = []
+    def on_reject(file_name, problem):
+        rejected.append((file_name, problem))
+        write_turn_save(path)
+    assert watch.wait_for_turn_save(game, settle=0, on_reject=on_reject) \
+        == path
+    assert rejected == [(path, "Password not set")]
+
+def test_turn_save_problem_of_missing_save(server, interface, tmp_path):
+    game = games.Game(interface, server.games[0])
+    path = str(tmp_path / 'replaced.Civ5Save')
+    assert watch.turn_save_problem(game, path) == "Not a complete save"
+    write_turn_save(path)
+    assert watch.turn_save_problem(game, path) is None